@@ -0,0 +1,135 @@
+"""
+Summarizes the access logs written by access_log.py, per host and per
+scraper, to show which sources take up the most of a run.
+For each host or scraper it reports the number of requests, how many failed
+(no response, or a 4xx/5xx status), retries, cache hits, requests that
+shared the response to an identical one, latency percentiles, and the total
+time and bytes. Rows are sorted by total time.
+Logs can be JSON lines or tab-separated text, and rotated files can be
+given alongside the current one.
+Usage:
+    python access_log_summary.py access.jsonl access.jsonl.1 --by host --top 20
+"""
+
+import argparse
+import collections
+import json
+import sys
+import urlparse
+
+# Field order of a text log entry; see access_log.TEXT_ENTRY_FMT.
+TEXT_FIELDS = ('timestamp', 'method', 'uri', 'status', 'elapsed', 'size',
+    'retries', 'cache', 'source', 'error')
+
+PERCENTILES = (50, 90, 99)
+
+
+def parse_line(line):
+    "Returns the entry dictionary for a line of a JSON or text access log, or None."
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+    else:
+        values = line.split('\t')
+        if len(values) < 6:
+            return None
+        entry = dict(zip(TEXT_FIELDS, values))
+        for key in ('status', 'size', 'retries'):
+            entry[key] = int(entry[key]) if entry.get(key) else None
+        entry['elapsed'] = float(entry['elapsed']) if entry.get('elapsed') else None
+    if not entry.get('host'):
+        entry['host'] = urlparse.urlsplit(entry.get('uri') or '').netloc.lower()
+    return entry
+
+def read_entries(filenames):
+    for filename in filenames:
+        with open(filename) as fp:
+            for line in fp:
+                entry = parse_line(line)
+                if entry is not None:
+                    yield entry
+
+def is_error(entry):
+    return entry.get('status') is None or entry['status'] >= 400
+
+def percentile(sorted_values, p):
+    "Returns the p-th percentile of the given sorted values, by nearest rank."
+    if not sorted_values:
+        return None
+    index = max(0, int(round(p / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+def summarize(entries, key):
+    """
+    Returns a list of summary dictionaries, one for each distinct value of
+    entry[key], sorted by total elapsed time, slowest first.
+    """
+    groups = collections.defaultdict(list)
+    for entry in entries:
+        groups[entry.get(key) or '-'].append(entry)
+    rows = []
+    for name, group in groups.items():
+        elapsed = sorted(e['elapsed'] for e in group if e.get('elapsed') is not None)
+        num_errors = len([e for e in group if is_error(e)])
+        row = {
+            key: name,
+            'requests': len(group),
+            'errors': num_errors,
+            'error_rate': float(num_errors) / len(group),
+            'retries': sum(e.get('retries') or 0 for e in group),
+            'cache_hits': len([e for e in group if e.get('cache') == 'hit']),
+            'shared': len([e for e in group if e.get('cache') == 'shared']),
+            'seconds': sum(elapsed),
+            'bytes': sum(e.get('size') or 0 for e in group),
+        }
+        for p in PERCENTILES:
+            row['p%s' % p] = percentile(elapsed, p)
+        rows.append(row)
+    rows.sort(key=lambda row: row['seconds'], reverse=True)
+    return rows
+
+def format_seconds(value):
+    return '-' if value is None else '%.3f' % value
+
+def print_summary(rows, key, fp=sys.stdout):
+    row_format = '{0:<45} {1:>8} {2:>7} {3:>7} {4:>6} {5:>6} {6:>8} {7:>8} {8:>8} {9:>10} {10:>10}\n'
+    fp.write(row_format.format(key, 'requests', 'errors', 'retries', 'cache', 'shared',
+        'p50', 'p90', 'p99', 'seconds', 'MB'))
+    for row in rows:
+        fp.write(row_format.format(row[key][:45], row['requests'],
+            '%.1f%%' % (100 * row['error_rate']), row['retries'], row['cache_hits'], row['shared'],
+            format_seconds(row['p50']), format_seconds(row['p90']), format_seconds(row['p99']),
+            '%.1f' % row['seconds'], '%.1f' % (row['bytes'] / 1048576.0)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize scraper access logs.')
+    parser.add_argument('filenames', nargs='+', help='access log files (JSON lines or text)')
+    parser.add_argument('--by', choices=('host', 'source'), action='append',
+        help='group by host or by scraper (default: both)')
+    parser.add_argument('--top', type=int, help='only show the slowest N rows of each table')
+    parser.add_argument('--json', action='store_true', help='print the summaries as JSON')
+    args = parser.parse_args(argv)
+
+    entries = list(read_entries(args.filenames))
+    summaries = collections.OrderedDict()
+    for key in args.by or ('host', 'source'):
+        summaries[key] = summarize(entries, key)[:args.top]
+
+    if args.json:
+        json.dump(summaries, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+    print '%s requests in %s.\n' % (len(entries), ', '.join(args.filenames))
+    for key, rows in summaries.items():
+        print_summary(rows, key)
+        print
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
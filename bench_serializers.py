@@ -0,0 +1,68 @@
+"""
+Micro-benchmark for serializers.dumps().
+Compares the way Scraper.run() used to encode output -- stringify the dates,
+json.dumps() each record in create_newsitem(), then json.dumps() that string
+again when writing the list -- against encoding each record once with every
+backend in serializers.BACKENDS that's installed.
+Usage:
+    python bench_serializers.py [number of records]
+"""
+
+import datetime
+import decimal
+import json
+import os.path as op
+import sys
+import time
+
+sys.path.insert(0, op.join(op.dirname(op.abspath(__file__)), 'boston'))
+import serializers
+
+
+class FakePoint(object):
+    "Stands in for a GEOS Point, which needs GDAL to construct."
+    def __init__(self, x, y):
+        self.wkt = 'POINT (%r %r)' % (x, y)
+
+
+def make_records(count):
+    pub_date = datetime.datetime(2016, 3, 1, 12, 30)
+    for i in xrange(count):
+        yield {
+            'title': u'Aggravated assault at %s Main St' % i,
+            'description': u'Reported at 12:30 p.m. \u2014 case %s' % i,
+            'url': 'http://example.com/reports/%s' % i,
+            'pub_date': pub_date,
+            'item_date': pub_date.date() - datetime.timedelta(days=i % 30),
+            'location': FakePoint(-71.06 + i * 1e-6, 42.36),
+            'location_name': u'%s Main St' % i,
+            'location_id': None,
+            'amount': decimal.Decimal('%s.25' % i),
+        }
+
+def old_path(records):
+    for ni in records:
+        ni = dict(ni, pub_date=str(ni['pub_date']), item_date=str(ni['item_date']),
+            location=ni['location'].wkt, amount=str(ni['amount']))
+        json.dumps(json.dumps(ni))
+
+def new_path(dumps, records):
+    for ni in records:
+        dumps(ni)
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main(count=100000):
+    records = list(make_records(count))
+    baseline = timed(old_path, records)
+    print '%-24s %8.3fs %10.0f records/s' % ('old (json, twice)', baseline, count / baseline)
+    for name, dumps in serializers.BACKENDS:
+        elapsed = timed(new_path, dumps, records)
+        print '%-24s %8.3fs %10.0f records/s  %.1fx' % (name, elapsed, count / elapsed, baseline / elapsed)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
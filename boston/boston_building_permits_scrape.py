@@ -9,6 +9,7 @@ CSV_URL = 'https://data.boston.gov/dataset/cd1ec3ff-6ebf-4a65-af68-8329eceab740/
 class BuildingPermitScraper(Scraper):
    schema = 'building-permits'
    primary_key = ('permit_number',)
+   download_parts = 4 # Fetch the CSV as byte ranges in parallel, if the server allows.
 
    def data(self):
        cutoff_date = self.start_date - datetime.timedelta(days=30)
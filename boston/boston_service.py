@@ -16,7 +16,7 @@ class ServiceRequestScraper(Scraper):
     primary_key = ('service_request_id',)
 
     def data(self):
-        min_date = datetime.date.today() - datetime.timedelta(days=3)
+        min_date = self.since_watermark(3)
         pipeline = Pipeline(min_date=min_date)
 
         for request in pipeline.get_values():
@@ -0,0 +1,57 @@
+"""
+Checkpoints for long-running scrapes.
+A Checkpoint is a small JSON file that records how far a scrape got -- a
+"cursor" such as the last completed date or list page -- plus whatever else
+the scraper needs to pick up where it left off. It's written atomically, so a
+crash can never leave a half-written checkpoint behind.
+"""
+
+import datetime
+import json
+import os
+
+
+def _default(obj):
+    # JSON has no date types, so tag them and turn them back into dates in
+    # _object_hook().
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(obj, datetime.date):
+        return {'__date__': obj.strftime('%Y-%m-%d')}
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _object_hook(dic):
+    if '__datetime__' in dic:
+        return datetime.datetime.strptime(dic['__datetime__'], '%Y-%m-%dT%H:%M:%S.%f')
+    if '__date__' in dic:
+        return datetime.datetime.strptime(dic['__date__'], '%Y-%m-%d').date()
+    return dic
+
+
+class Checkpoint(object):
+    """
+    Reads and writes a checkpoint file. State is a dictionary that must be
+    JSON-serializable, except that dates and datetimes are allowed. Note that
+    tuples come back as lists.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def load(self):
+        "Returns the saved state, or None if there's no checkpoint."
+        if not os.path.exists(self.file_path):
+            return None
+        with open(self.file_path) as fp:
+            return json.load(fp, object_hook=_object_hook)
+
+    def save(self, state):
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(state, fp, default=_default)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temp_path, self.file_path)
+
+    def clear(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
@@ -20,6 +20,9 @@ WEB_BASE_URL = 'https://mayors24.cityofboston.gov/reports/'
 class Pipeline(sundew_pipeline.Pipeline):
     name = 'boston.service_requests'
 
+    # Number of items downloaded at once.
+    item_concurrency = 4
+
     def __init__(self, *args, **kwargs):
         # If not specified, min_date defaults to yesterday.
         if 'min_date' in kwargs:
@@ -50,7 +53,7 @@ class Pipeline(sundew_pipeline.Pipeline):
         Stages used to get the final result items.
         """
         return [
-            self.download_and_wait,
+            stages.Map(self.download_and_wait, concurrency=self.item_concurrency),
             stages.ParseJson,
             self.get_final,
         ]
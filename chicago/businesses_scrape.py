@@ -271,8 +271,9 @@ class BusinessLicenseScraper(Scraper):
     primary_key = ('license_number', 'item_date')
 
     def data(self):
-        # Build an inline query for business licenses that took effect within the past 90 days:
-        start_date = datetime.date.today() - datetime.timedelta(days=90)
+        # Build an inline query for business licenses that took effect since
+        # the last run (or within the past 90 days):
+        start_date = self.since_watermark(90)
         inline_query = INLINE_QUERY_TEMPLATE % {
             'start_date': start_date.strftime('%Y-%m-%dT00:00:00'),
         }
@@ -40,11 +40,10 @@ class LiquorLicenseScraper(Scraper):
             )
 
     def get_liquor_licenses(self):
-        text = self.cache_get('data', 'csv', DATA_URL)
-        sio = StringIO(text)
-        reader = csv.reader(sio)
-        keys = tuple(t.lower().strip() for t in reader.next())
-        for dic in reader:
+        filename = self.cache_get_to_file('data', 'csv', DATA_URL)
+        with open(filename) as fp:
+            reader = csv.reader(fp)
+            keys = tuple(t.lower().strip() for t in reader.next())
             for row in reader:
                 yield dict(zip(keys, row))
 
@@ -83,8 +83,9 @@ class FoodInspectionScraper(Scraper):
             )
 
     def get_food_inspections(self):
-        # Build an inline query for food inspections performed within the past 90 days:
-        start_date = datetime.date.today() - datetime.timedelta(days=90)
+        # Build an inline query for food inspections performed since the last
+        # run (or within the past 90 days):
+        start_date = self.since_watermark(90)
         inline_query = INLINE_QUERY_TEMPLATE % {
             'start_date': start_date.strftime('%Y-%m-%dT00:00:00'),
         }
@@ -0,0 +1,83 @@
+"""
+On-disk index of records a scraper has already saved.
+For every (schema, primary key) pair, the index stores a hash of the record's
+contents. Scraper.save() uses it to tell whether a record is new, changed or
+identical to what was saved by a previous run.
+"""
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+
+ADDED = 'added'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def _default(obj):
+    # GEOS geometries serialize to WKT; dates, times and anything else fall
+    # back to their string representation.
+    if hasattr(obj, 'wkt'):
+        return obj.wkt
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    return unicode(obj)
+
+def encode(obj):
+    "Returns a stable JSON encoding of obj, suitable for hashing."
+    return json.dumps(obj, sort_keys=True, default=_default)
+
+def digest(datadict, ignore_fields=()):
+    "Returns a hash of the given dictionary, ignoring the given keys."
+    values = dict((k, v) for k, v in datadict.items() if k not in ignore_fields)
+    return hashlib.sha1(encode(values)).hexdigest()
+
+
+class RecordIndex(object):
+    """
+    Maps (schema, primary key) to the hash of the last saved version of each
+    record. Changes are only written to disk when commit() is called, so a
+    run that fails part way through leaves the index as it was.
+    """
+    def __init__(self, file_path, schema):
+        self.schema = schema
+        # The index may be shared by Scraper.save_concurrently() workers.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS records '
+            '(schema text, key text, digest text, PRIMARY KEY (schema, key));')
+        self.conn.commit()
+
+    def check(self, key_values, datadict, ignore_fields=()):
+        """
+        Returns ADDED, CHANGED or UNCHANGED for the given record, and
+        remembers its new hash.
+        """
+        key = encode(list(key_values))
+        new_digest = digest(datadict, ignore_fields)
+        with self.lock:
+            self.cursor.execute('SELECT digest FROM records WHERE schema = ? AND key = ?;',
+                (self.schema, key))
+            row = self.cursor.fetchone()
+            if row is None:
+                status = ADDED
+            elif row[0] == new_digest:
+                return UNCHANGED
+            else:
+                status = CHANGED
+            self.cursor.execute('INSERT OR REPLACE INTO records (schema, key, digest) VALUES (?, ?, ?);',
+                (self.schema, key, new_digest))
+        return status
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        "Closes the index, discarding anything that wasn't committed."
+        with self.lock:
+            self.conn.rollback()
+            self.conn.close()
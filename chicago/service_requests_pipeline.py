@@ -22,6 +22,9 @@ WEB_BASE_URL = 'http://servicetracker.cityofchicago.org/requests/'
 class Pipeline(sundew_pipeline.Pipeline):
     name = 'chicago.service_requests'
 
+    # Number of items downloaded at once.
+    item_concurrency = 4
+
     def __init__(self, *args, **kwargs):
         # If not specified, min_date defaults to yesterday.
         if 'min_date' in kwargs:
@@ -52,7 +55,7 @@ class Pipeline(sundew_pipeline.Pipeline):
         Stages used to get the final result items.
         """
         return [
-            self.download_and_wait,
+            stages.Map(self.download_and_wait, concurrency=self.item_concurrency),
             stages.ParseJson,
             self.get_final,
         ]
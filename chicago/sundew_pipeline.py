@@ -1,5 +1,7 @@
 import inspect
+import json
 import os
+import sys
 import os.path as op
 import sqlite3
 import zlib
@@ -15,6 +17,11 @@ import requests
 import stages
 #import utils
 import keyvalue
+import http_pool
+import rate_limit
+import access_log
+import single_flight
+import mirror
 import re
 from HTMLParser import HTMLParser
 from dateutil.parser import parse as duparse
@@ -23,7 +30,100 @@ class StopPipeline(Exception):
     pass
 
 
+class StageStats(object):
+    """
+    What went through one stage of a pipeline run and how long it took.
+    `seconds` is the total time spent getting items from the stage, which
+    includes the time the stage spent waiting for items from the stage
+    before it (`waiting`). The difference is the time the stage itself
+    took, in step() or otherwise.
+    """
+    def __init__(self, name, upstream=None):
+        self.name = name
+        self.upstream = upstream
+        self.items_out = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.last_error = None
+
+    @property
+    def items_in(self):
+        return self.upstream.items_out if self.upstream else None
+
+    @property
+    def waiting(self):
+        return self.upstream.seconds if self.upstream else 0.0
+
+    @property
+    def self_seconds(self):
+        return max(0.0, self.seconds - self.waiting)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'errors': self.errors,
+            'seconds': round(self.self_seconds, 4),
+            'waiting': round(self.waiting, 4),
+        }
+
+
+class InstrumentedStage(object):
+    """
+    Wraps the iterator of a stage's output, counting items and errors in
+    the StageStats and timing each item. An exception is only counted as
+    an error of the stage it came from, not of the stages it passes
+    through on its way out.
+    """
+    def __init__(self, iterator, stats):
+        self.iterator = iterator
+        self.stats = stats
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            value = next(self.iterator)
+        except (StopIteration, StopPipeline):
+            self.stats.seconds += time.time() - start
+            raise
+        except Exception as e:
+            self.stats.seconds += time.time() - start
+            upstream = self.stats.upstream
+            if upstream is None or upstream.last_error is not e:
+                self.stats.errors += 1
+            self.stats.last_error = e
+            raise
+        self.stats.seconds += time.time() - start
+        self.stats.items_out += 1
+        return value
+
+    def close(self):
+        if hasattr(self.iterator, 'close'):
+            self.iterator.close()
+
+
 class Pipeline(object):
+    # Maximum number of requests a second to any one host, or None for no
+    # limit, shared with every scraper in the process. See rate_limit.
+    rate_limit = None
+    rate_burst = 1
+
+    # get() requests identical to one in flight, or to one that got a 2xx
+    # or 3xx response in the last coalesce_ttl seconds, in this or any other
+    # pipeline or scraper in the process, share its response. Set to None to always
+    # make the request.
+    coalesce_ttl = 5
+
+    # Number of steps get_values_async() runs at once in each async_safe
+    # stage (see stages.PipelineStage), on greenlets if the process uses
+    # gevent or on threads otherwise.
+    async_concurrency = 100
+    async_threads = 16
+
     def __init__(self, name=None, debug=False):
         self.name = getattr(self, 'name', name)
         if not self.name:
@@ -54,18 +154,21 @@ class Pipeline(object):
         """
         pass
 
-    def get_values(self):
+    def get_values(self, concurrency=None):
         self.finished = False
-        # Use a different session for each run.
-        self.session = requests.Session()
+        # Use a different session for each run, but share its connections
+        # with every other pipeline in the process.
+        self.session = http_pool.get_pool().mount(requests.Session())
 
         self.before_run()
 
         self.stages = self.get_stages()
 
         generators = []
+        self.stage_stats = []
 
         for i, stage in enumerate(self.stages):
+            name = stage_name(stage)
             if i == 0:
                 if isinstance(stage, list) or isinstance(stage, tuple):
                     # An input sequence that kicks everything off.
@@ -76,11 +179,13 @@ class Pipeline(object):
                 elif isinstance(stage, stages.PipelineStage):
                     generator = stage.as_generator_func(self)()
             else:
+                if inspect.isclass(stage) and issubclass(stage, stages.PipelineStage):
+                    # Is a subclass of stages.PipelineStage.
+                    stage = stage()
                 if isinstance(stage, stages.PipelineStage):
+                    if concurrency and stage.async_safe and stage.concurrency == 1:
+                        stage.concurrency = concurrency
                     func = stage.as_generator_func(self)
-                elif inspect.isclass(stage) and issubclass(stage, stages.PipelineStage):
-                    # Is a subclass of stages.PipelineStage.
-                    func = stage().as_generator_func(self)
                 elif inspect.isgeneratorfunction(stage):
                     func = generator_func_wrapper(stage)
                 elif callable(stage):
@@ -90,7 +195,9 @@ class Pipeline(object):
 
                 generator = func(generators[-1])
 
-            generators.append(generator)
+            stats = StageStats(name, self.stage_stats[-1] if self.stage_stats else None)
+            self.stage_stats.append(stats)
+            generators.append(InstrumentedStage(generator, stats))
 
         self.generators = generators
 
@@ -105,23 +212,87 @@ class Pipeline(object):
 
         self.after_run()
 
-    def run(self):
-        t_start = time.clock()
+    def get_values_async(self, concurrency=None):
+        """
+        Like get_values(), but for pipelines that spend nearly all their time
+        waiting on the network: every stage after the first that's marked
+        async_safe and doesn't set its own concurrency (see
+        stages.PipelineStage) runs up to `concurrency` steps at once, keeping
+        the order of the results. Download stages are async_safe; wrap a
+        function that is in stages.Map(func, async_safe=True). Everything
+        else, including plain and generator functions, which often change
+        the pipeline's state, still runs one item at a time.
+        If the process was started with gevent's monkey patching, as in
+            python -m gevent.monkey flickr_pipeline.py
+        the steps run on greenlets, and async_concurrency of them can wait on
+        the network at once on a single thread. Otherwise, they run on
+        async_threads threads. The session keeps http_pool's number of
+        connections to each host open between requests, so raise that with
+        http_pool.configure() to reuse more of them.
+        """
+        if concurrency is None:
+            concurrency = self.async_concurrency if is_cooperative() else self.async_threads
+        return self.get_values(concurrency)
+
+    def run_async(self, concurrency=None, report_path=None):
+        "Like run(), with get_values_async()."
+        self.run(self.get_values_async(concurrency), report_path)
+
+    def run(self, values=None, report_path=None):
+        """
+        Prints every object the pipeline returns, and then how long the run
+        took and a table of what each stage did. If `report_path` is given,
+        the same report is also written there as JSON.
+        """
+        t_start = time.time()
 
         count = 0
-        for count, data in enumerate(self.get_values(), 1):
+        if values is None:
+            values = self.get_values()
+        for count, data in enumerate(values, 1):
             if isinstance(data, dict):
                 pprint.pprint(data)
             else:
                 print(data)
 
-        t_end = time.clock()
+        t_end = time.time()
         delta = dateutil.relativedelta.relativedelta(seconds=t_end - t_start)
 
         print
         print '\nFinished in {} minutes and {} seconds.'.format(
             delta.minutes, delta.seconds)
         print 'Returned {} objects.'.format(count)
+        print
+        self.print_report()
+        if report_path:
+            with open(report_path, 'w') as fp:
+                json.dump(self.get_report(t_end - t_start, count), fp, indent=2)
+
+    def get_report(self, seconds=None, count=None):
+        """
+        Returns a dictionary describing the last run: its wall-clock time and
+        number of objects, if given, and the StageStats of each stage.
+        """
+        return {
+            'name': self.name,
+            'seconds': seconds,
+            'count': count,
+            'stages': [stats.as_dict() for stats in self.stage_stats],
+        }
+
+    def print_report(self, fp=sys.stdout):
+        """
+        Prints a table of the items into and out of each stage of the last
+        run, its errors, the time it took itself and the time it spent
+        waiting for the stage before it, and its share of the total.
+        """
+        row = '{0:<40} {1:>8} {2:>8} {3:>6} {4:>10} {5:>10} {6:>6}\n'
+        fp.write(row.format('stage', 'in', 'out', 'errors', 'seconds', 'waiting', '%'))
+        total = sum(stats.self_seconds for stats in self.stage_stats) or 1.0
+        for stats in self.stage_stats:
+            fp.write(row.format(stats.name[:40], '-' if stats.items_in is None else stats.items_in,
+                stats.items_out, stats.errors, '%.3f' % stats.self_seconds,
+                '%.3f' % stats.waiting, '%.1f' % (100 * stats.self_seconds / total)))
 
     def stop(self):
         for gen in self.generators:
@@ -140,15 +311,32 @@ class Pipeline(object):
             response = self.cache.get('GET', url)
             if response is not None:
                 print('Retrieving from cache: {}'.format(url))
+                access_log.record('GET', url, response.status_code, 0, len(response.content),
+                    cache='hit', source=self.name)
                 return response
             else:
                 print('Downloading: {}'.format(url))
-                response = self.session.get(url, **kwargs)
+                response = self.request('GET', url, **kwargs)
                 if response.status_code == 200:
                     self.cache.set(response)
                 return response
+        elif self.coalesce_ttl is not None and not kwargs.get('stream'):
+            return self.coalesced_get(url, **kwargs)
         else:
-            return self.session.get(url, **kwargs)
+            return self.request('GET', url, **kwargs)
+
+    def coalesced_get(self, url, **kwargs):
+        """
+        Makes a GET request, or shares the response to an identical one. A
+        request is identical if it has the same URL, arguments and session
+        cookies.
+        """
+        def fetch():
+            return self.request('GET', url, **kwargs)
+        options = sorted((k, v) for k, v in kwargs.items() if k != 'headers')
+        extra = (repr(options), repr(sorted(self.session.cookies.items())))
+        return single_flight.coalesce(fetch, 'GET', url, kwargs.get('headers'), self.coalesce_ttl,
+            lambda response: response.status_code, self.name, extra)[0]
 
     def get_to_file(self, url, data=None, **kwargs):
         """
@@ -159,17 +347,19 @@ class Pipeline(object):
             response = self.cache.get('GET', url)
             if response is not None:
                 print('Retrieving from cache: {}'.format(url))
+                access_log.record('GET', url, response.status_code, 0, len(response.content),
+                    cache='hit', source=self.name)
                 return self.temp_file(response.content)
             else:
                 print('Downloading: {}'.format(url))
-                response = self.session.get(url, **kwargs)
+                response = self.request('GET', url, **kwargs)
                 if response.status_code == 200:
                     self.cache.set(response)
                 return self.temp_file(response.content)
         else:
             # Turn on streaming to conserve memory usage.
             kwargs['stream'] = kwargs.get('stream', True)
-            response = self.session.get(url, **kwargs)
+            response = self.request('GET', url, **kwargs)
             return self.temp_file(response.iter_content(512))
 
     def post(self, url, data=None, **kwargs):
@@ -177,32 +367,101 @@ class Pipeline(object):
             response = self.cache.get('POST', url, data)
             if response is not None:
                 print('Retrieving from cache: {} (POST)'.format(url))
+                access_log.record('POST', url, response.status_code, 0, len(response.content),
+                    cache='hit', source=self.name)
                 return response
             else:
                 print('Downloading: {} (POST)'.format(url))
-                response = self.session.post(url, data, **kwargs)
+                response = self.request('POST', url, data, **kwargs)
                 self.cache.set(response)
                 return response
         else:
-            return self.session.post(url, data, **kwargs)
+            return self.request('POST', url, data, **kwargs)
 
     def post_to_file(self, url, data=None, **kwargs):
         if self.debug:
             response = self.cache.get('POST', url, data)
             if response is not None:
                 print('Retrieving from cache: {} (POST)'.format(url))
+                access_log.record('POST', url, response.status_code, 0, len(response.content),
+                    cache='hit', source=self.name)
                 return self.temp_file(response.content)
             else:
                 print('Downloading: {} (POST)'.format(url))
-                response = self.session.post(url, data, **kwargs)
+                response = self.request('POST', url, data, **kwargs)
                 self.cache.set(response)
                 return self.temp_file(response.content)
         else:
             # Turn on streaming to conserve memory usage.
             kwargs['stream'] = kwargs.get('stream', True)
-            response = self.session.post(url, data, **kwargs)
+            response = self.request('POST', url, data, **kwargs)
             return self.temp_file(response.iter_content(512))
 
+    def request(self, method, url, data=None, **kwargs):
+        """
+        Makes a request with the pipeline's session, after waiting for the
+        rate limit, and records it in the access log. In mirror mode, GETs
+        are answered from the mirror if it has a copy; see mirror.
+        """
+        mirror_url = None
+        if method == 'GET' and mirror.get_store() is not None:
+            mirror_url = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+            response = self.mirrored_response(mirror_url, kwargs.get('stream'))
+            if response is not None:
+                return response
+        self.throttle(url)
+        start = time.time()
+        try:
+            response = self.session.request(method, url, data=data, **kwargs)
+        except Exception as e:
+            access_log.record(method, url, elapsed=time.time() - start, source=self.name, error=str(e))
+            raise
+        if kwargs.get('stream'):
+            # The body hasn't been read yet.
+            size = response.headers.get('content-length')
+            size = int(size) if size else None
+        else:
+            size = len(response.content)
+        access_log.record(method, url, response.status_code, time.time() - start, size, source=self.name)
+        if mirror_url is not None and not kwargs.get('stream'):
+            mirror.save(mirror_url, dict(response.headers, status=response.status_code), response.content)
+        return response
+
+    def mirrored_response(self, url, stream=False):
+        """
+        Returns a requests.Response for the mirror's copy of the given URL,
+        or None if it doesn't have one. If `stream` is True, the body is read
+        from the copy on disk as it's needed, and the file is closed once all
+        of it has been read or the response is closed. If the mirror is
+        offline, raises mirror.NotMirrored if it doesn't have a copy.
+        """
+        store = mirror.get_store()
+        entry = mirror.lookup(url)
+        if entry is None:
+            if mirror.is_offline():
+                raise mirror.NotMirrored('%s is not in the mirror at %s' % (url, store.directory))
+            return None
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        headers = entry.resp_headers()
+        del headers['status']
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        if stream:
+            response.raw = entry.open()
+        else:
+            with open(entry.filename, 'rb') as fp:
+                response._content = fp.read()
+            response._content_consumed = True
+        access_log.record('GET', url, 200, 0, os.path.getsize(entry.filename), cache='hit',
+            source=self.name)
+        return response
+
+    def throttle(self, url):
+        "Waits until the rate limit for the URL's host allows another request."
+        rate_limit.get_limiter().wait(url, self.rate_limit, self.rate_burst)
+
     def temp_file(self, data=None):
         tf = tempfile.TemporaryFile()
         if data:
@@ -242,6 +501,27 @@ class Pipeline(object):
         parser.feed(html)
         return parser.get_text()
 
+def stage_name(stage):
+    "Returns a name for a stage to show in reports."
+    if isinstance(stage, (list, tuple)):
+        return 'input'
+    if isinstance(stage, stages.Map):
+        return 'Map({})'.format(stage_name(stage.func))
+    if isinstance(stage, stages.PipelineStage):
+        return type(stage).__name__
+    return getattr(stage, '__name__', repr(stage))
+
+def is_cooperative():
+    """
+    Returns True if gevent has monkey patched the process, so that threads
+    are greenlets and sockets don't block them.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket') and monkey.is_module_patched('threading')
+
 def generator_func_wrapper(fn):
     def result(source):
         for data in source:
@@ -19,7 +19,7 @@ class CrimeScraper(Scraper):
  #   title_format = u'{offense_code.name}'
 
     def data(self):
-        cutoff_date = self.start_date - datetime.timedelta(days=90)
+        cutoff_date = self.since_watermark(90)
         for report in self.get_crime_reports():
             try:
                 dt = self.datetime(report['"first_occurrence_date"'], '%m/%d/%Y %H:%M:%S %p')
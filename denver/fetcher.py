@@ -0,0 +1,112 @@
+"""
+Concurrent fetching for scrapers that make many independent requests.
+fetch_all() hands each request to a fetch function in a pool of threads, with
+a limit on how many requests run at once overall and per host, and yields
+the results either in input order or as they complete. Since almost all of a
+fetch is spent waiting on the network, wall-clock time scales with the
+concurrency level even with the GIL.
+"""
+
+import sys
+import threading
+import Queue
+
+from http_pool import get_host
+
+
+def request_host(request):
+    """
+    Returns the host a request is for. A request is a URL, or a tuple or list
+    whose first item is a URL.
+    """
+    if isinstance(request, (tuple, list)):
+        request = request[0]
+    return get_host(request)
+
+
+class HostLimiter(object):
+    "Hands out a semaphore for each host, allowing `per_host` at a time."
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __getitem__(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.Semaphore(self.per_host)
+            return self.semaphores[host]
+
+
+def fetch_all(fetch, requests, concurrency=8, per_host=None, ordered=True, host=request_host):
+    """
+    Calls fetch(request) for every request in the given iterable, running up
+    to `concurrency` calls at once and no more than `per_host` (by default,
+    `concurrency`) for the same host. Yields (request, result) tuples, in the
+    order of `requests` if `ordered` is True or as they complete otherwise.
+    `requests` is consumed lazily, with at most 2 * concurrency requests
+    fetched but not yet yielded. If a fetch raises an exception, it's
+    re-raised here with its original traceback and no more requests are
+    started.
+    """
+    limiter = HostLimiter(per_host or concurrency)
+    work = Queue.Queue()
+    results = Queue.Queue()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            index, request = item
+            try:
+                with limiter[host(request)]:
+                    result = fetch(request)
+            except:
+                results.put((index, request, False, sys.exc_info()))
+            else:
+                results.put((index, request, True, result))
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    requests = iter(requests)
+    window = 2 * concurrency
+    num_submitted = num_yielded = 0
+    exhausted = False
+    finished = {} # Results that arrived ahead of their turn, if ordered.
+    try:
+        while True:
+            while not exhausted and num_submitted - num_yielded < window:
+                try:
+                    request = next(requests)
+                except StopIteration:
+                    exhausted = True
+                    break
+                work.put((num_submitted, request))
+                num_submitted += 1
+            if num_yielded == num_submitted:
+                break
+            index, request, ok, value = results.get()
+            if not ok:
+                raise value[0], value[1], value[2]
+            if ordered:
+                finished[index] = (request, value)
+                while num_yielded in finished:
+                    yield finished.pop(num_yielded)
+                    num_yielded += 1
+            else:
+                num_yielded += 1
+                yield request, value
+    finally:
+        # Drop any requests that haven't started, then tell the workers to
+        # stop. Fetches that are in progress are left to finish on their own.
+        try:
+            while True:
+                work.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            work.put(None)
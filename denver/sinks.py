@@ -0,0 +1,145 @@
+"""
+Output sinks for Scraper.run().
+A sink receives every record returned by Scraper.save() and writes it to disk
+as soon as it arrives, so a scrape never has to hold its whole output in
+memory.
+"""
+
+import gzip
+import json
+import logging
+import os
+import serializers
+
+
+class NDJsonSink(object):
+    """
+    Writes records as newline-delimited JSON (one record per line).
+    Records are written to a temporary file next to `filename` and flushed
+    every `flush_every` records. The temporary file is only renamed to
+    `filename` when commit() is called, so readers never see a partially
+    written file. If `compress` is True, the output is gzipped and '.gz' is
+    appended to the filename.
+    For checkpointed scrapes, checkpoint() makes everything written so far
+    durable and returns an offset that resume() can later truncate the
+    temporary file back to, and keep_partial stops close() from deleting it.
+    """
+    def __init__(self, filename, flush_every=1000, compress=False):
+        if compress and not filename.endswith('.gz'):
+            filename += '.gz'
+        self.filename = filename
+        self.temp_filename = filename + '.part'
+        self.flush_every = flush_every
+        self.compress = compress
+        self.num_written = 0
+        self.keep_partial = False
+        self.logger = logging.getLogger('eb.retrieval.sinks')
+        self._fp = None
+
+    def open(self, mode='wb'):
+        if self.compress:
+            self._fp = gzip.open(self.temp_filename, mode)
+        else:
+            self._fp = open(self.temp_filename, mode)
+        return self
+
+    def write(self, record):
+        """
+        Writes a single record. Strings are assumed to be JSON already;
+        anything else is encoded with serializers.dumps().
+        """
+        if self._fp is None:
+            self.open()
+        if not isinstance(record, basestring):
+            record = serializers.dumps(record)
+        if isinstance(record, unicode):
+            record = record.encode('utf8')
+        self._fp.write(record)
+        self._fp.write('\n')
+        self.num_written += 1
+        if self.flush_every and self.num_written % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+            if not self.compress:
+                os.fsync(self._fp.fileno())
+
+    def checkpoint(self):
+        """
+        Flushes everything written so far to disk and returns the size of the
+        temporary file, to be passed to resume().
+        """
+        if self._fp is None:
+            self.open()
+        if self.compress:
+            # A gzip stream can't be cut off in the middle, so finish this
+            # member and start a new one. Concatenated members are still a
+            # valid gzip file.
+            self._fp.close()
+            self.open('ab')
+        else:
+            self.flush()
+        return os.path.getsize(self.temp_filename)
+
+    def resume(self, offset, num_written):
+        """
+        Reopens the temporary file left by an earlier run, throwing away
+        anything written after the checkpoint that returned `offset`.
+        Returns False, leaving the sink to start a fresh file, if the
+        temporary file is gone or shorter than `offset`.
+        """
+        if not os.path.exists(self.temp_filename) or os.path.getsize(self.temp_filename) < offset:
+            return False
+        with open(self.temp_filename, 'r+b') as fp:
+            fp.truncate(offset)
+        self.num_written = num_written
+        self.open('ab')
+        return True
+
+    def commit(self):
+        """
+        Closes the temporary file and atomically moves it into place.
+        """
+        if self._fp is None:
+            self.open()
+        self.flush()
+        self._fp.close()
+        self._fp = None
+        os.rename(self.temp_filename, self.filename)
+        self.logger.info('Wrote %s records to %s', self.num_written, self.filename)
+
+    def close(self):
+        """
+        Discards the temporary file if commit() was never called, unless
+        keep_partial is set. It's safe to call this after commit().
+        """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            if not self.keep_partial and os.path.exists(self.temp_filename):
+                os.remove(self.temp_filename)
+
+
+class JsonListSink(NDJsonSink):
+    """
+    Writes records as a single JSON list, which is the format run() used
+    before sinks existed. Records are still streamed to disk one at a time.
+    """
+    def write(self, record):
+        if self._fp is None:
+            self.open()
+        self._fp.write(',' if self.num_written else '[')
+        if not isinstance(record, basestring):
+            record = serializers.dumps(record)
+        self._fp.write(json.dumps(record))
+        self.num_written += 1
+        if self.flush_every and self.num_written % self.flush_every == 0:
+            self.flush()
+
+    def commit(self):
+        if self._fp is None:
+            self.open()
+        self._fp.write(']' if self.num_written else '[]')
+        super(JsonListSink, self).commit()
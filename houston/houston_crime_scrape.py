@@ -28,6 +28,7 @@ CRIME_TYPES = {
 class CrimeScraper(Scraper):
     schema = 'crime-reports'
     primary_key = ('offense', 'item_date', 'offense_time', 'premise_type', 'location_name')
+    checkpoint = True
 
     def data(self):
         for crime in self.get_crimes():
@@ -63,14 +64,27 @@ class CrimeScraper(Scraper):
             }
 
     def get_crimes(self):
+        # The checkpoint cursor is the last [district, offense code] pair
+        # that was finished.
+        done = self.resume_cursor()
+        queries = []
         for police_district in range(1, 25):
-            for offense_code in CRIME_TYPES.keys():
-                url = get_url(police_district, offense_code)
-                result = self.cache_get(
-                    '{}_{}'.format(police_district, offense_code),
-                    'json', url, make_pretty=True)
-                for crime in json.loads(result)['features']:
-                    yield crime
+            for offense_code in sorted(CRIME_TYPES.keys()):
+                if done is None or [police_district, offense_code] > done:
+                    url = get_url(police_district, offense_code)
+                    queries.append((url, police_district, offense_code))
+
+        # The queries are independent, so run several at once. Results come
+        # back in order, which keeps the checkpoints valid.
+        for (url, police_district, offense_code), result in self.fetch_all(queries, self.query):
+            for crime in json.loads(result)['features']:
+                yield crime
+            self.save_checkpoint([police_district, offense_code])
+
+    def query(self, query):
+        url, police_district, offense_code = query
+        return self.cache_get('{}_{}'.format(police_district, offense_code),
+            'json', url, make_pretty=True)
 
 
 def get_url(police_district, offense_code):
@@ -91,7 +91,7 @@ class RestaurantScraper(NewsItemListDetailScraper):
         '<td[^>]*>(?P<activity>[^<]*)</td>\s*</tr>.*?'
         '<table[^>]*>(?P<violations_html>.*?)</table>'
     )
-    sleep = 2
+    rate_limit = 0.5 # Requests a second.
 
     def __init__(self, start_date=None, end_date=None):
         NewsItemListDetailScraper.__init__(self)
@@ -101,25 +101,34 @@ class RestaurantScraper(NewsItemListDetailScraper):
         self.start_date, self.end_date = start_date, end_date
 
     def list_pages(self):
-        # Submit a search for each facility type.
-        for code, facility_type in FACILITY_TYPES:
-            data = {
-                'q': 's',
-                'e': '',
-                'k': '',
-                'r': '',
-                'tp': code,
-                'sd': self.start_date.strftime('%m/%d/%Y'),
-                'ed': self.end_date.strftime('%m/%d/%Y'),
-                'z': 'ALL',
-                'm': 'LIKE',
-                'maxrows': '500',
-            }
-            html = self.get_html('http://houston-tx.healthinspections.us/media/search.cfm', data, send_cookies=False)
-            # Convert to Unicode to handle non-ASCII characters.
-            html = html.decode('iso-8859-1')
+        # Submit a search for each facility type, several at a time.
+        # rate_limit still starts at most one search every two seconds, the
+        # pace the old sleep set, so this only overlaps each search's
+        # response with the wait for the next; the run is still bound by
+        # the politeness limit.
+        searches = [('http://houston-tx.healthinspections.us/media/search.cfm', code, facility_type)
+            for code, facility_type in FACILITY_TYPES]
+        for (url, code, facility_type), html in self.fetch_all(searches, self.search):
             yield (facility_type, html)
 
+    def search(self, search):
+        url, code, facility_type = search
+        data = {
+            'q': 's',
+            'e': '',
+            'k': '',
+            'r': '',
+            'tp': code,
+            'sd': self.start_date.strftime('%m/%d/%Y'),
+            'ed': self.end_date.strftime('%m/%d/%Y'),
+            'z': 'ALL',
+            'm': 'LIKE',
+            'maxrows': '500',
+        }
+        html = self.get_html(url, data, send_cookies=False)
+        # Convert to Unicode to handle non-ASCII characters.
+        return html.decode('iso-8859-1')
+
     def parse_list(self, page):
         facility_type, html = page
         for record in NewsItemListDetailScraper.parse_list(self, html):
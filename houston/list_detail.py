@@ -1,4 +1,5 @@
 from retrieval_base import BaseScraper, ScraperBroken
+from checkpoint import Checkpoint
 
 class SkipRecord(Exception):
     "Exception that signifies a detail record should be skipped over."
@@ -28,7 +29,14 @@ class ListDetailScraper(BaseScraper):
     These are additional, optional hooks:
         * clean_list_record()
         * clean_detail_record()
+    To let update() resume after a failure, set checkpoint = True and have
+    list_pages() start from resume_cursor() and call save_checkpoint() after
+    each page it yields.
     """
+    checkpoint = False
+    checkpoint_path = None # Defaults to <class name>-checkpoint.json.
+    checkpoint_counters = ('list_records_seen', 'detail_records_seen', 'num_skipped')
+    _checkpoint = _resume_state = None
 
     ################################
     # MAIN METHODS FOR OUTSIDE USE #
@@ -89,17 +97,60 @@ class ListDetailScraper(BaseScraper):
         self.detail_records_seen = 0
         self.num_skipped = 0
         self.logger.info("update() started")
+        self.start_checkpoint()
         try:
             for page in self.list_pages():
                 try:
                     self.update_from_string(page)
                 except StopScraping:
                     break
+            if self._checkpoint is not None:
+                self._checkpoint.clear()
         finally:
+            self._checkpoint = self._resume_state = None
             self.logger.info("update() finished")
             self.logger.info("list records seen: %s" % self.list_records_seen)
             self.logger.info("detail records seen: %s" % self.detail_records_seen)
             self.logger.info("records skipped: %s" % self.num_skipped)
+            encoding_sources = getattr(self.retriever, 'encoding_sources', None)
+            if encoding_sources:
+                self.logger.info("page encodings found by: %s" % ', '.join(
+                    '%s %s' % item for item in sorted(encoding_sources.items())))
+
+    def start_checkpoint(self):
+        """
+        Loads the checkpoint left by a failed update(), if any, and restores
+        the counters as of that checkpoint.
+        """
+        self._resume_state = None
+        if not self.checkpoint:
+            return
+        self._checkpoint = Checkpoint(self.checkpoint_path or '%s-checkpoint.json' % self.__class__.__name__)
+        state = self._checkpoint.load()
+        if state is None:
+            return
+        self.logger.info("resuming from checkpoint %r" % (state['cursor'],))
+        for name in self.checkpoint_counters:
+            setattr(self, name, state.get(name, 0))
+        self._resume_state = state
+
+    def resume_cursor(self):
+        "Returns the cursor of the checkpoint update() resumed from, or None."
+        if self._resume_state is None:
+            return None
+        return self._resume_state['cursor']
+
+    def save_checkpoint(self, cursor):
+        """
+        Records that every list page up to and including `cursor` has been
+        saved. `cursor` must be JSON-serializable (dates are OK). Does nothing
+        if checkpointing is off.
+        """
+        if self._checkpoint is None:
+            return
+        state = dict((name, getattr(self, name)) for name in self.checkpoint_counters)
+        state['cursor'] = cursor
+        self._checkpoint.save(state)
 
     def update_from_string(self, page):
         """
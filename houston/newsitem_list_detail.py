@@ -29,6 +29,7 @@ class NewsItemListDetailScraper(ListDetailScraper):
     schema_slugs = None
     logname = None
     record_check = None
+    checkpoint_counters = ListDetailScraper.checkpoint_counters + ('num_added', 'num_changed')
 
     def __init__(self, *args, **kwargs):
         super(NewsItemListDetailScraper, self).__init__(*args, **kwargs)
@@ -5,12 +5,23 @@ knows nothing about *scraping*, i.e., parsing the contents of Web pages.
 """
 
 import httplib2
+import http_pool
+import retries
+import streaming
+import single_flight
+from rate_limit import get_limiter, rate_from_sleep
+from access_log import LOG_ENTRY_FMT
 from Cookie import SimpleCookie, CookieError
 from urllib import urlencode
 from urlparse import urljoin
+from collections import Counter
+import codecs
+import copy
 import logging
-import time
+import os
+import re
 import socket
+import threading
 
 class RetrievalError(Exception):
     "Couldn't retrieve data"
@@ -21,91 +32,113 @@ class PageNotFoundError(RetrievalError):
     pass
 
 
+# A charset in a Content-Type header or in a <meta> tag, which can be either
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="...; charset=...">.
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_RE = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# Every byte value, for telling single-byte encodings apart.
+ALL_BYTES = ''.join(chr(i) for i in range(256))
+
+def normalize_encoding(name):
+    "Returns Python's name for the given charset, or None if it doesn't know it."
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def decodes_anything(encoding):
+    """
+    Returns True for single-byte encodings such as latin-1 and cp1252, which
+    decode nearly any bytes, so a page in some other encoding decodes under
+    them without an error, just garbled.
+    """
+    try:
+        return ALL_BYTES.decode(encoding, 'replace').count(u'\ufffd') < 16
+    except LookupError:
+        return False
+
+def decodes_cleanly(sample, encoding):
+    "Returns True if the start of a page decodes under the given encoding."
+    try:
+        # The sample may end in the middle of a multi-byte character.
+        codecs.getincrementaldecoder(encoding)().decode(sample, False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
 class Default:
     # Used to determine whether a default argument was given to Retriever.__init__().
     pass
 
-LOG_ENTRY_FMT = "%(timestamp)s\t%(method)s\t%(uri)s\t%(status)s\t%(elapsed)s\t%(size)s"
-
 class Retriever(object):
     'HTTP client.'
-    def __init__(self, user_agent=None, timeout=20, sleep=0, disable_ssl_certificate_validation=True):
-        # sleep should be the number of seconds to sleep between requests.
-        self.h = httplib2.Http(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_certificate_validation)
+    def __init__(self, user_agent=None, timeout=20, sleep=0, disable_ssl_certificate_validation=True,
+            retry_policy=None, circuit_breaker=None, rate_limit=None, rate_burst=1, source=None,
+            coalesce_ttl=5):
+        # rate_limit is the maximum number of requests a second to any one
+        # host, shared with everything else in the process that uses that
+        # host. sleep is the old way of saying the same thing: the number of
+        # seconds between requests.
+        # retry_policy and circuit_breaker default to the shared ones in
+        # the retries module. source is the name requests are recorded under
+        # in the access log.
+        # GETs identical to one in flight, or to one that got a 2xx or 3xx
+        # response in the last coalesce_ttl seconds, anywhere in the
+        # process, share its response. Set coalesce_ttl to None to always make the request.
+        self.retry_policy = retry_policy or retries.RetryPolicy()
+        self.source = source
+        self.circuit_breaker = circuit_breaker or retries.circuit_breaker
+        # Connections come from a pool shared by every Retriever and Scraper
+        # in the process.
+        self.h = http_pool.PooledHttp(timeout=timeout, disable_ssl_certificate_validation=disable_ssl_certificate_validation)
         self.h.force_exception_to_status_code = False
         self.h.follow_redirects = False
         self.user_agent = user_agent or 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.0)'
         self._cookies = SimpleCookie()
         self.logger = logging.getLogger('eb.retrieval.retriever')
-        self.sleep = sleep
-
-        # Keep track of whether we've downloaded any pages yet.
-        # This makes sure we don't sleep before the very first requested page.
-        self.page_downloaded = False
+        # Totals for downloads streamed by get_to_file(): bytes received and
+        # bytes after decompression.
+        self.bytes_downloaded = self.bytes_decoded = 0
+        self.rate_limit = rate_limit or rate_from_sleep(sleep)
+        self.rate_burst = rate_burst
+        self.coalesce_ttl = coalesce_ttl
 
     def clear_cookies(self):
         self._cookies = SimpleCookie()
 
     def get_html_and_headers(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
         "Retrieves the resource and returns a tuple of (content, header dictionary)."
-        # Sleep, if necessary, but only if a page has already been downloaded
-        # with this retriever. (We don't want to sleep before the very first
-        # request that a retriever makes, because that would be unnecessary.)
-        if self.sleep and self.page_downloaded:
-            self.logger.debug('Sleeping for %s seconds', self.sleep)
-            time.sleep(self.sleep)
-        self.page_downloaded = True
-
-        # Prepare the request.
-        if not headers:
-            headers = {}
-        headers['user-agent'] = headers.get('user-agent', self.user_agent)
+        method, body, headers = self.prepare_request(data, headers, send_cookies)
 
-        # Take care of cookie header, if necessary.
-        if send_cookies and self._cookies:
-            # Some broken ASP.NET servers put "\r\n" in there, so we replace
-            # that with semicolon to get proper behavior.
-            headers['Cookie'] = self._cookies.output(attrs=[], header='').strip().replace('\r\n', ';')
-
-        method = data and "POST" or "GET"
-        body = urlencode(data) if isinstance(data, dict) else data
-        if method == "POST" and body and 'Content-Type' not in headers:
-            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
-
-        # Get the response.
-        resp_headers = None
-        for attempt_number in range(3):
-            self.logger.debug('Attempt %s: %s', attempt_number + 1, method)
+        # Get the response, retrying according to retry_policy.
+        def attempt():
+            self.logger.debug('Attempt: %s', method)
+            get_limiter().wait(uri, self.rate_limit, self.rate_burst, self.logger)
             try:
-                resp_headers, content = self.h.request(uri, method, body=body, headers=headers)
-                if resp_headers['status'] == '500':
-                    self.logger.debug("Request got a 500 error: %s", method)
-                    continue # Try again.
-                break
-            except socket.timeout:
-                self.logger.debug("Request timed out after %s seconds: %s ", self.h.timeout, method)
-                continue # Try again.
-            except socket.error, e:
-                self.logger.debug("Got socket error: %s", e)
-                continue # Try again.
+                return self.h.request(uri, method, body=body, headers=headers)
             except httplib2.ServerNotFoundError:
                 raise RetrievalError("Could not %s : server not found" % (method))
-        if resp_headers is None:
-            raise RetrievalError("Request timed out 3 times: %s " % (method))
-
-        # Raise RetrievalError if necessary.
-        if raise_on_error and resp_headers['status'] in ('400', '408', '500'):
-            raise RetrievalError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
-        if raise_on_error and resp_headers['status'] == '404':
-            raise PageNotFoundError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
+        def fetch():
+            return retries.call_with_retries(attempt, uri, method,
+                self.retry_policy, self.circuit_breaker, self.logger, RetrievalError, self.source)
+        if method == 'GET' and self.coalesce_ttl is not None:
+            (resp_headers, content), shared = single_flight.coalesce(fetch, method, uri, headers,
+                self.coalesce_ttl, lambda result: result[0]['status'], self.source)
+            if shared:
+                resp_headers = copy.copy(resp_headers)
+        else:
+            resp_headers, content = fetch()
 
-        # Set any received cookies.
-        if 'set-cookie' in resp_headers:
-            try:
-                self._cookies.load(resp_headers['set-cookie'])
-            except CookieError:
-                # Skip invalid cookies.
-                pass
+        self.check_status(method, uri, resp_headers['status'], raise_on_error)
+        self.set_cookies(resp_headers)
 
         # Handle redirects that weren't caught by httplib2 for whatever reason.
         if follow_redirects and resp_headers['status'] in ('301', '302', '303'):
@@ -127,54 +160,201 @@ class Retriever(object):
 
         return content, resp_headers
 
+    def prepare_request(self, data=None, headers=None, send_cookies=True):
+        """
+        Returns a tuple of (method, body, headers) for a request with the
+        given POST data, adding the user agent and cookie headers.
+        """
+        if not headers:
+            headers = {}
+        headers['user-agent'] = headers.get('user-agent', self.user_agent)
+
+        # Take care of cookie header, if necessary.
+        if send_cookies and self._cookies:
+            # Some broken ASP.NET servers put "\r\n" in there, so we replace
+            # that with semicolon to get proper behavior.
+            headers['Cookie'] = self._cookies.output(attrs=[], header='').strip().replace('\r\n', ';')
+
+        method = data and "POST" or "GET"
+        body = urlencode(data) if isinstance(data, dict) else data
+        if method == "POST" and body and 'Content-Type' not in headers:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return method, body, headers
+
+    def check_status(self, method, uri, status, raise_on_error=True):
+        "Raises RetrievalError if raise_on_error is set and the status is an error."
+        if raise_on_error and (status in ('400', '408') or status in self.retry_policy.retry_statuses):
+            raise RetrievalError("Could not %s %r: HTTP status %s" % (method, uri, status))
+        if raise_on_error and status == '404':
+            raise PageNotFoundError("Could not %s %r: HTTP status %s" % (method, uri, status))
+
+    def set_cookies(self, resp_headers):
+        "Keeps any cookies set by the given response."
+        if 'set-cookie' in resp_headers:
+            try:
+                self._cookies.load(resp_headers['set-cookie'])
+            except CookieError:
+                # Skip invalid cookies.
+                pass
+
     def get_html(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
         "Retrieves the resource and returns it as raw HTML."
         return self.get_html_and_headers(uri, data, headers, send_cookies, follow_redirects, raise_on_error, basic_auth)[0]
 
-    def get_to_file(self, *args, **kwargs):
+    def get_to_file(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
         """
         Downloads the given URI and saves it to a temporary file. Returns the
-        full filename of the temporary file.
+        full filename of the temporary file. The response body is written to
+        the file as it arrives instead of being held in memory, and is
+        requested with gzip or deflate compression and decompressed on the
+        fly.
         """
-        import os
         from tempfile import mkstemp
+        method, body, headers = self.prepare_request(data, headers, send_cookies)
         fd, name = mkstemp()
         fp = os.fdopen(fd, 'wb')
-        fp.write(self.get_html(*args, **kwargs))
-        fp.close()
+
+        def attempt():
+            self.logger.debug('Attempt: %s (streaming)', method)
+            # Start over if an earlier attempt wrote part of the body.
+            fp.seek(0)
+            fp.truncate()
+            get_limiter().wait(uri, self.rate_limit, self.rate_burst, self.logger)
+            try:
+                result = streaming.download(uri, fp, method, body, headers, self.h.timeout,
+                    self.h.disable_ssl_certificate_validation, follow_redirects)
+            except socket.gaierror:
+                raise RetrievalError("Could not %s : server not found" % (method))
+            self.bytes_downloaded += result.bytes_received
+            self.bytes_decoded += result.bytes_decoded
+            self.logger.debug('Downloaded %s bytes, %s decoded', result.bytes_received, result.bytes_decoded)
+            return result.resp_headers, result
+        try:
+            try:
+                resp_headers, result = retries.call_with_retries(attempt, uri, method,
+                    self.retry_policy, self.circuit_breaker, self.logger, RetrievalError, self.source)
+            finally:
+                fp.close()
+            self.check_status(method, uri, resp_headers['status'], raise_on_error)
+        except:
+            os.unlink(name)
+            raise
+        self.set_cookies(resp_headers)
         return name
 
 class UnicodeRetriever(Retriever):
     """
     Like Retriever, but get_html() returns a Unicode object instead of a
-    bytestring. It uses the chardet module to determine the encoding to use.
+    bytestring. The encoding comes from, in order of preference, a byte order
+    mark, the charset in the Content-Type header, a <meta> charset near the
+    start of the page, the encoding found earlier for the same host, or the
+    chardet module's guess from the start of the page. How many pages each
+    of those decided is counted in encoding_sources. A page that doesn't
+    decode under that encoding is tried as UTF-8, then under chardet's guess
+    from the whole page, then as cp1252.
     """
+    # Number of bytes at the start of a page that are searched for a <meta>
+    # charset and, failing that, given to chardet. chardet is slow, and
+    # looking at the whole of a large page rarely changes its mind.
+    sample_size = 8192
+
+    # Maps hosts to the encoding chardet found for their pages, for pages
+    # that don't declare one. Single-byte encodings aren't kept, and a kept
+    # encoding is only used for a page whose start decodes under it. Shared
+    # by every UnicodeRetriever, including ones in fetch_all() threads, so
+    # it's only changed with the lock held, which also guards
+    # encoding_sources.
+    host_encodings = {}
+    host_encodings_lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
         # errors can be 'strict', 'ignore' or 'replace'. See Python docs.
         self.error_handling = kwargs.pop('errors', 'strict')
         Retriever.__init__(self, *args, **kwargs)
+        self.encoding_sources = Counter()
 
-    def get_html_and_headers(self, *args, **kwargs):
-        encoding, content, headers = self.get_encoding_html_and_headers(*args, **kwargs)
+    def get_html_and_headers(self, uri, *args, **kwargs):
+        encoding, content, headers = self.get_encoding_html_and_headers(uri, *args, **kwargs)
         try:
             return content.decode(encoding, self.error_handling), headers
         except UnicodeDecodeError:
-            # Sometimes chardet makes a mistake and returns a totally wrong
-            # encoding. In case that happens, just try UTF-8.
-            if encoding.lower() != 'utf-8':
-                return content.decode('utf-8', self.error_handling), headers
-            else:
-                raise RetrievalError('Page content could not be converted to a unicode string.')
-
-    def get_encoding_html_and_headers(self, *args, **kwargs):
+            pass
+        # The encoding was wrong, so don't use it for this host again.
+        host = http_pool.get_host(uri)
+        with self.host_encodings_lock:
+            if self.host_encodings.get(host) == encoding:
+                self.host_encodings.pop(host, None)
+        tried = set([encoding.lower()])
+        for fallback in self.fallback_encodings(content):
+            if not fallback or fallback.lower() in tried:
+                continue
+            tried.add(fallback.lower())
+            try:
+                result = content.decode(fallback, self.error_handling)
+            except (UnicodeDecodeError, LookupError):
+                continue
+            self.logger.debug('Decoded %s as %s instead of %s', uri, fallback, encoding)
+            return result, headers
+        raise RetrievalError('Page content could not be converted to a unicode string.')
+
+    def fallback_encodings(self, content):
+        """
+        Yields the encodings to try, in order, for a page that didn't decode
+        under the one detect_encoding() found. chardet's guess from the start
+        of a page can be wrong, and a start that's all ASCII says nothing
+        about the rest, so this tries UTF-8, then chardet's guess from the
+        whole page, then cp1252.
+        """
+        yield 'utf-8'
+        import chardet
+        yield chardet.detect(content)['encoding']
+        yield 'cp1252'
+
+    def get_encoding_html_and_headers(self, uri, *args, **kwargs):
         """
         Returns a tuple of (encoding, html_bytestring, headers).
         This is useful if you don't know whether you want to decode the string
         until *after* calling this method. (Perhaps you want to inspect the
         headers.)
         """
+        content, headers = Retriever.get_html_and_headers(self, uri, *args, **kwargs)
+        encoding, source = self.detect_encoding(uri, content, headers)
+        with self.host_encodings_lock:
+            self.encoding_sources[source] += 1
+        self.logger.debug('Encoding of %s is %s, from %s', uri, encoding, source)
+        return encoding, content, headers
+
+    def detect_encoding(self, uri, content, headers):
+        """
+        Returns a tuple of (encoding, source) for the given page, where
+        source says how the encoding was found: 'bom', 'header', 'meta',
+        'host', 'chardet' or 'default'.
+        """
+        for bom, encoding in BOMS:
+            if content.startswith(bom):
+                return encoding, 'bom'
+        match = CHARSET_RE.search(headers.get('content-type', ''))
+        if match and normalize_encoding(match.group(1)):
+            return normalize_encoding(match.group(1)), 'header'
+        sample = content[:self.sample_size]
+        match = META_CHARSET_RE.search(sample)
+        if match and normalize_encoding(match.group(1)):
+            return normalize_encoding(match.group(1)), 'meta'
+        host = http_pool.get_host(uri)
+        encoding = self.host_encodings.get(host)
+        if encoding is not None and decodes_cleanly(sample, encoding):
+            return encoding, 'host'
         import chardet
-        content, headers = Retriever.get_html_and_headers(self, *args, **kwargs)
-        guess = chardet.detect(content)
-        # Maybe this should take into account guess['confidence']?
-        return guess['encoding'], content, headers
+        encoding = chardet.detect(sample)['encoding']
+        if not encoding:
+            return 'utf-8', 'default'
+        if encoding.lower() == 'ascii':
+            # The sample can be all ASCII even when the rest of the page
+            # isn't, and UTF-8 decodes ASCII just the same.
+            encoding = 'utf-8'
+        # A wrong single-byte guess would never fail to decode, so it would
+        # garble the host's later pages instead of being dropped.
+        if not decodes_anything(encoding):
+            with self.host_encodings_lock:
+                self.host_encodings[host] = encoding
+        return encoding, 'chardet'
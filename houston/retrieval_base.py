@@ -1,6 +1,9 @@
 from retrieval import Retriever
+import fetcher
 import datetime
 import logging
+import os
+import sys
 
 class ScraperBroken(Exception):
     "Something changed in the underlying HTML and broke the scraper."
@@ -11,16 +14,40 @@ class BaseScraper(object):
     Base class for all scrapers in everyblock.retrieval.scrapers.
     """
     logname = 'basescraper'
-    sleep = 0
+    # Maximum number of requests a second to any one host, or None for no
+    # limit. See Retriever.
+    rate_limit = None
+    rate_burst = 1
+    # fetch_all() makes up to fetch_concurrency requests at once, and no more
+    # than fetch_per_host to the same host.
+    fetch_concurrency = 8
+    fetch_per_host = 4
 
     def __init__(self):
-        self.retriever = Retriever(sleep=self.sleep)
+        self.retriever = Retriever(rate_limit=self.rate_limit, rate_burst=self.rate_burst,
+            source=self.get_source())
         self.logger = logging.getLogger('eb.retrieval.%s' % self.logname)
         self.start_time = datetime.datetime.now()
 
+    def get_source(self):
+        "Returns the name this scraper's requests are logged under, e.g. 'houston/RestaurantScraper'."
+        module = sys.modules[self.__module__]
+        metro = os.path.basename(os.path.dirname(os.path.abspath(module.__file__)))
+        return '%s/%s' % (metro, type(self).__name__)
+
     def update(self):
         'Run the scraper.'
         raise NotImplementedError()
 
     def get_html(self, *args, **kwargs):
         return self.retriever.get_html(*args, **kwargs)
+
+    def fetch_all(self, requests, fetch=None, ordered=True, host=fetcher.request_host):
+        """
+        Fetches many independent requests concurrently and yields (request,
+        result) tuples, in input order if `ordered` is True or as they
+        complete otherwise. `fetch` defaults to get_html(), so `requests` can
+        just be URLs. See fetcher.fetch_all().
+        """
+        return fetcher.fetch_all(fetch or self.get_html, requests, self.fetch_concurrency,
+            self.fetch_per_host, ordered, host)
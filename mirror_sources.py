@@ -0,0 +1,118 @@
+"""
+Fills the local mirror that scrapers read from in mirror mode (see
+mirror.py in any metro directory) and keeps it up to date.
+The URLs mirrored are every module-level *_URL constant in the metro
+directories that's a complete URL, such as CSV_URL and DATA_URL, plus every
+URL already in the store. Scrapers running in mirror mode add the URLs they
+build at run time, such as API queries, so those are kept up to date too,
+until no scraper has asked for them for a while (see mirror.SAVED_TTL), when
+they're deleted.
+Copies checked less than --max-age hours ago are left alone, and older ones
+are checked with a conditional GET, so unchanged files aren't downloaded
+again. Run it from cron outside business hours, or leave it running with
+--every:
+    python mirror_sources.py --store /var/eb/mirror --max-age 12 --every 60
+    python run_scrapers.py --mirror /var/eb/mirror
+"""
+
+import argparse
+import ast
+import logging
+import os
+import os.path as op
+import re
+import sys
+import time
+
+import run_scrapers
+
+ROOT = op.dirname(op.abspath(__file__))
+
+# Every metro directory has the same copy of mirror.py and the modules it
+# uses; this one is used to fetch.
+LIBRARY_DIR = op.join(ROOT, 'boston')
+
+URL_RE = re.compile(r'^https?://')
+
+# Constants that are only the start of a URL, or that need values filled in.
+PARTIAL_NAME_RE = re.compile(r'BASE|TEMPL')
+PARTIAL_URL_RE = re.compile(r'[{}<>%]|INLINE')
+
+logger = logging.getLogger('eb.retrieval.mirror_sources')
+
+
+def module_urls(path):
+    "Yields (name, URL) for each module-level URL constant in the given module."
+    with open(path) as fp:
+        tree = ast.parse(fp.read(), path)
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or not isinstance(node.value, ast.Str):
+            continue
+        for target in node.targets:
+            if not isinstance(target, ast.Name) or 'URL' not in target.id:
+                continue
+            url = node.value.s
+            if URL_RE.match(url) and not PARTIAL_NAME_RE.search(target.id) and not PARTIAL_URL_RE.search(url):
+                yield target.id, url
+
+def discover_urls(root=ROOT, metro_dirs=run_scrapers.METRO_DIRS):
+    "Returns a sorted list of (URL, 'directory/module.NAME') for every source URL constant."
+    urls = []
+    for metro_dir in metro_dirs:
+        for dirpath, dirnames, filenames in os.walk(op.join(root, metro_dir)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                name, ext = op.splitext(filename)
+                if ext != '.py' or name in run_scrapers.LIBRARY_MODULES:
+                    continue
+                path = op.join(dirpath, filename)
+                try:
+                    for constant, url in module_urls(path):
+                        urls.append((url, '%s/%s.%s' % (op.relpath(dirpath, root), name, constant)))
+                except SyntaxError:
+                    logger.warning('Could not parse %s', path)
+    return sorted(urls)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mirror scraper sources locally.')
+    parser.add_argument('--store', default='mirror', help='directory of the mirror')
+    parser.add_argument('--max-age', type=float, default=12,
+        help='hours before a copy is checked for changes')
+    parser.add_argument('--every', type=float,
+        help='keep running, starting a pass every this many minutes')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of downloads at once')
+    parser.add_argument('--per-host', type=int, default=1,
+        help='maximum number of downloads from the same host at once')
+    parser.add_argument('--rate', type=float,
+        help='maximum number of requests a second to the same host')
+    parser.add_argument('--list', action='store_true', help='list the URLs and exit')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    sys.path.insert(0, LIBRARY_DIR)
+    import mirror
+
+    store = mirror.MirrorStore(op.abspath(args.store))
+    while True:
+        sources = discover_urls()
+        urls = sorted(set(url for url, name in sources) | set(store.urls()))
+        if args.list:
+            names = dict(sources)
+            for url in urls:
+                print '%s %s' % (url, names.get(url, '(from the store)'))
+            return 0
+        start = time.time()
+        num_expired = store.prune()
+        if num_expired:
+            logger.info('Deleted %s expired copies', num_expired)
+        outcomes = mirror.prefetch(store, urls, args.max_age * 3600, args.concurrency,
+            args.per_host, args.rate, logger=logger)
+        logger.info('Mirrored %s URLs in %.1f seconds: %s', len(urls), time.time() - start,
+            ', '.join('%s %s' % (count, outcome) for outcome, count in sorted(outcomes.items())))
+        if args.every is None:
+            return 1 if outcomes['failed'] else 0
+        time.sleep(max(0, start + args.every * 60 - time.time()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+"""
+Local mirror of source data.
+Scrapers normally download their sources while they run, so a run takes as
+long as the slowest city portal and competes with every other scraper for
+bandwidth. A MirrorStore holds a copy of each source URL on disk, filled
+ahead of time by mirror_sources.py in the repository root, on its own
+schedule. In mirror mode, Scraper and Pipeline GETs are answered from the
+store when it has a copy, which makes a run depend only on the disk.
+Mirror mode is turned on by calling configure() or by setting the EB_MIRROR
+environment variable to the store's directory (which run_scrapers.py
+--mirror does). EB_MIRROR_MODE says what happens to URLs the store doesn't
+have:
+    read     Download them as usual and add them to the store, so that
+             mirror_sources.py keeps them up to date from then on.
+    offline  Fail, without touching the network.
+URLs added in read mode are often queries that are only made once, such as
+ones with the date of the last run in them, so they're dropped from the
+store once no scraper has asked for them for SAVED_TTL seconds.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import fetcher
+import retries
+import streaming
+from rate_limit import get_limiter
+
+MODES = ('read', 'offline')
+
+# Response headers that still describe the body once it's in the store.
+# Bodies are stored decompressed, so Content-Encoding isn't one of them.
+KEPT_HEADERS = ('content-type', 'content-disposition', 'etag', 'last-modified')
+
+# How long a URL added in read mode is kept without being asked for.
+SAVED_TTL = 2 * 24 * 3600
+
+
+class NotMirrored(Exception):
+    "The mirror is offline and doesn't have a copy of the URL."
+    pass
+
+
+class MirrorEntry(object):
+    def __init__(self, url, filename, fetched_at, headers, expires_at=None):
+        self.url = url
+        self.filename = filename
+        self.fetched_at = fetched_at
+        self.headers = headers
+        self.expires_at = expires_at # None if the copy is kept until deleted.
+
+    def age(self):
+        "Returns the number of seconds since the copy was last checked."
+        return time.time() - self.fetched_at
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= time.time()
+
+    def resp_headers(self):
+        "Returns a response header dictionary for the copy."
+        headers = dict(self.headers, status='200')
+        headers['content-length'] = str(os.path.getsize(self.filename))
+        return headers
+
+    def open(self):
+        """
+        Returns a file-like object for reading the copy that closes itself
+        once it's been read to the end, for a response body that's streamed
+        by code that never closes the response.
+        """
+        return ClosingReader(self.filename)
+
+    def validators(self):
+        "Returns the request headers that ask for the URL only if it has changed."
+        headers = {}
+        if self.headers.get('etag'):
+            headers['If-None-Match'] = str(self.headers['etag'])
+        if self.headers.get('last-modified'):
+            headers['If-Modified-Since'] = str(self.headers['last-modified'])
+        return headers
+
+
+class ClosingReader(object):
+    def __init__(self, filename):
+        self.fp = open(filename, 'rb')
+
+    def read(self, size=-1):
+        if self.fp.closed:
+            return ''
+        data = self.fp.read(size)
+        if not data or size < 0:
+            self.fp.close()
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+class MirrorStore(object):
+    """
+    Stores the body of each URL in `directory`, named after a hash of the
+    URL, with a .json file next to it that holds the URL, the time it was
+    last fetched or found to be unchanged, its response headers and, for a
+    copy that isn't kept for good, the time it expires.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def get_paths(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        key = hashlib.sha1(url).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path, path + '.json'
+
+    def read_meta(self, meta_filename):
+        try:
+            with open(meta_filename) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def get(self, url, expired=False):
+        """
+        Returns the MirrorEntry for the given URL, or None. An expired copy
+        is only returned if `expired` is True.
+        """
+        filename, meta_filename = self.get_paths(url)
+        meta = self.read_meta(meta_filename)
+        if meta is None or meta.get('url') != url or not os.path.exists(filename):
+            return None
+        entry = MirrorEntry(url, filename, meta['fetched_at'], meta['headers'], meta.get('expires_at'))
+        if entry.is_expired() and not expired:
+            return None
+        return entry
+
+    def put(self, url, filename, resp_headers, copy=False, expires_at=None):
+        """
+        Moves (or, if `copy` is True, copies) the file holding the body of a
+        response for the given URL into the store, replacing any earlier
+        copy, and returns its MirrorEntry. The copy is kept until
+        `expires_at`, or for good if that's None.
+        """
+        headers = dict((k.lower(), v) for k, v in resp_headers.items() if k.lower() in KEPT_HEADERS)
+        mirror_filename, meta_filename = self.get_paths(url)
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        # Put the file somewhere else in the directory first and then rename
+        # it, so that a reader never sees part of a file.
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        if copy:
+            shutil.copyfile(filename, tmp_filename)
+        else:
+            shutil.move(filename, tmp_filename)
+        os.rename(tmp_filename, mirror_filename)
+        entry = MirrorEntry(url, mirror_filename, time.time(), headers, expires_at)
+        self.write_meta(entry)
+        return entry
+
+    def put_content(self, url, content, resp_headers, expires_at=None):
+        "Like put(), for a body that's in a string."
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        return self.put(url, tmp_filename, resp_headers, expires_at=expires_at)
+
+    def touch(self, url):
+        "Records that the copy of the given URL was found to be current."
+        entry = self.get(url)
+        if entry is not None:
+            entry.fetched_at = time.time()
+            self.write_meta(entry)
+
+    def renew(self, entry, ttl=SAVED_TTL):
+        """
+        Keeps a copy that expires for at least another `ttl` seconds, since
+        it's been asked for. To save writes, the expiry time is only moved
+        once less than half of `ttl` is left.
+        """
+        if entry.expires_at is not None and entry.expires_at - time.time() < ttl / 2:
+            entry.expires_at = time.time() + ttl
+            self.write_meta(entry)
+
+    def write_meta(self, entry):
+        meta = {
+            'url': entry.url,
+            'fetched_at': entry.fetched_at,
+            'headers': entry.headers,
+        }
+        if entry.expires_at is not None:
+            meta['expires_at'] = entry.expires_at
+        self.write_atomic(self.get_paths(entry.url)[1], json.dumps(meta))
+
+    def write_atomic(self, filename, content):
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(content)
+            os.rename(tmp_filename, filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+
+    def urls(self, expired=False):
+        """
+        Returns a sorted list of every URL in the store, including those
+        whose copies have expired only if `expired` is True.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        urls = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                meta = self.read_meta(os.path.join(self.directory, name))
+                if meta is None:
+                    continue
+                if expired or meta.get('expires_at') is None or meta['expires_at'] > now:
+                    urls.append(meta['url'])
+        return sorted(urls)
+
+    def prune(self):
+        "Deletes every expired copy, and returns how many there were."
+        expired = [url for url in self.urls(expired=True) if self.get(url) is None]
+        for url in expired:
+            self.delete(url)
+        return len(expired)
+
+    def delete(self, url):
+        for filename in self.get_paths(url):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+_store = None
+_mode = 'read'
+_configured = False
+_lock = threading.Lock()
+
+def configure(directory, mode='read'):
+    "Turns on mirror mode with the store in `directory`; see the module docstring."
+    global _store, _mode, _configured
+    if mode not in MODES:
+        raise ValueError('Unknown mirror mode %r' % mode)
+    with _lock:
+        _store = MirrorStore(directory) if directory else None
+        _mode = mode
+        _configured = True
+
+def get_store():
+    "Returns the MirrorStore if mirror mode is on, configuring from the environment if needed."
+    if not _configured:
+        configure(os.environ.get('EB_MIRROR'), os.environ.get('EB_MIRROR_MODE', 'read'))
+    return _store
+
+def is_offline():
+    return get_store() is not None and _mode == 'offline'
+
+def save(url, resp_headers, content=None, filename=None):
+    """
+    Adds a successful response to a GET of the given URL to the store, if
+    mirror mode is on, from either its content or a copy of the file it was
+    downloaded to. The copy expires after SAVED_TTL seconds unless it's
+    asked for again; see lookup().
+    """
+    store = get_store()
+    if store is None or str(resp_headers.get('status')) != '200':
+        return
+    expires_at = time.time() + SAVED_TTL
+    if filename is not None:
+        store.put(url, filename, resp_headers, copy=True, expires_at=expires_at)
+    else:
+        store.put_content(url, content, resp_headers, expires_at)
+
+def lookup(url):
+    """
+    Returns the MirrorEntry for a GET of the given URL if mirror mode is on
+    and the store has a copy, or None, and keeps a copy that expires for
+    another SAVED_TTL seconds.
+    """
+    store = get_store()
+    if store is None:
+        return None
+    entry = store.get(url)
+    if entry is not None:
+        store.renew(entry)
+    return entry
+
+
+def prefetch(store, urls, max_age=None, concurrency=4, per_host=1, rate=None,
+        timeout=60, policy=None, logger=None):
+    """
+    Downloads each of the given URLs into the store, unless its copy was
+    checked less than `max_age` seconds ago. Copies that are older are
+    checked with a conditional GET, so an unchanged file isn't downloaded
+    again. Up to `concurrency` URLs are fetched at once, no more than
+    `per_host` from the same host, and no more than `rate` requests a
+    second to a host. Returns a Counter of outcomes: 'fresh' (not checked),
+    'unchanged', 'fetched' and 'failed'. A copy that expires keeps its
+    expiry time when it's fetched again.
+    """
+    logger = logger or logging.getLogger('eb.retrieval.mirror')
+    policy = policy or retries.RetryPolicy()
+
+    def fetch(url):
+        entry = store.get(url)
+        if entry is not None and max_age is not None and entry.age() < max_age:
+            return 'fresh'
+        headers = entry.validators() if entry is not None else {}
+        if not os.path.isdir(store.directory):
+            os.makedirs(store.directory)
+        fd, filename = tempfile.mkstemp(dir=store.directory)
+        fp = os.fdopen(fd, 'wb')
+        def attempt():
+            fp.seek(0)
+            fp.truncate()
+            get_limiter().wait(url, rate, 1, logger)
+            result = streaming.download(url, fp, headers=headers, timeout=timeout)
+            return result.resp_headers, result
+        try:
+            try:
+                resp_headers, result = retries.call_with_retries(attempt, url, 'GET', policy,
+                    retries.circuit_breaker, logger, Exception, 'mirror')
+            finally:
+                fp.close()
+            status = resp_headers['status']
+            if status == '304' and entry is not None:
+                store.touch(url)
+                return 'unchanged'
+            if status != '200':
+                logger.warning('Could not mirror %s: HTTP status %s', url, status)
+                return 'failed'
+            store.put(url, filename, resp_headers,
+                expires_at=entry.expires_at if entry is not None else None)
+            logger.info('Mirrored %s (%s bytes)', url, result.bytes_decoded)
+            return 'fetched'
+        except Exception, e:
+            logger.warning('Could not mirror %s: %s', url, e)
+            return 'failed'
+        finally:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    outcomes = Counter()
+    for url, outcome in fetcher.fetch_all(fetch, urls, concurrency, per_host, ordered=False):
+        outcomes[outcome] += 1
+    return outcomes
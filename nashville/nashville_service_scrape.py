@@ -16,7 +16,7 @@ class ServiceRequestScraper(Scraper):
 
     def data(self):
 
-        pipeline = Pipeline()
+        pipeline = Pipeline(min_date=self.since_watermark(10))
 
         for request in pipeline.get_values():
             if 'issues' not in request:
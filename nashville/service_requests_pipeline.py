@@ -22,6 +22,12 @@ class Pipeline(sundew_pipeline.Pipeline):
     name = 'nashville.service_requests'
 
     def __init__(self, *args, **kwargs):
+        # If not specified, min_date defaults to 10 days ago.
+        if 'min_date' in kwargs:
+            self.min_date = kwargs.pop('min_date')
+        else:
+            self.min_date = datetime.date.today() - datetime.timedelta(days=10)
+
         super(Pipeline, self).__init__(*args, **kwargs)
 
     def get_stages(self):
@@ -39,7 +45,7 @@ class Pipeline(sundew_pipeline.Pipeline):
         Fetch successive pages from the API.
         """
         cur_datetime = datetime.datetime.isoformat(datetime.datetime.now())
-        yesterday_datetime = datetime.datetime.isoformat(datetime.datetime.now() - datetime.timedelta(days=10))
+        min_datetime = datetime.datetime.combine(self.min_date, datetime.time()).isoformat()
 
         for i in itertools.count(1):
             params = dict(
@@ -48,7 +54,7 @@ class Pipeline(sundew_pipeline.Pipeline):
                 per_page=100,
                 details='true',
                 before=cur_datetime,
-                after=yesterday_datetime,
+                after=min_datetime,
                 status='closed,acknowledged'
             )
             url = API_BASE_URL + urllib.urlencode(params)
@@ -0,0 +1,80 @@
+"""
+JSON encoding for scraper output.
+dumps() encodes a record in a single pass. Dates, times, datetimes, Decimals
+and GEOS geometries are handled by the encoder itself, so records don't need
+to be converted to strings first. The fastest available backend is used:
+orjson, then simplejson (only if its C speedups are compiled), then the
+standard library's json module.
+"""
+
+import datetime
+import decimal
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simplejson
+    # The pure-Python simplejson is slower than the stdlib's C encoder.
+    from simplejson import _speedups
+except ImportError:
+    simplejson = None
+
+
+# Looked up by exact type first, because default() is called for every
+# date in every record.
+CONVERTERS = {
+    datetime.date: datetime.date.isoformat,
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.time: datetime.time.isoformat,
+    decimal.Decimal: float,
+}
+
+def default(obj):
+    """
+    Encodes the types that JSON doesn't know about: dates and times as ISO
+    8601 strings, Decimals as numbers and geometries as WKT.
+    """
+    converter = CONVERTERS.get(type(obj))
+    if converter is not None:
+        return converter(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if hasattr(obj, 'wkt'):
+        return obj.wkt
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def dumps_orjson(obj):
+    return orjson.dumps(obj, default=default).decode('utf8')
+
+def make_json_dumps():
+    """
+    Returns a dumps() function that uses the standard library's json module.
+    JSONEncoder.encode() sets up a new C encoder on every call, which costs
+    about as much as encoding a small record, so this sets one up once. It
+    can be reused because it doesn't check for circular references.
+    """
+    from json import encoder
+    if encoder.c_make_encoder is not None:
+        try:
+            iterencode = encoder.c_make_encoder(None, default,
+                encoder.encode_basestring_ascii, None, ': ', ', ', False, False, True)
+        except TypeError:
+            # Different Python version, different signature.
+            pass
+        else:
+            return lambda obj: ''.join(iterencode(obj, 0))
+    return json.JSONEncoder(default=default, check_circular=False).encode
+
+BACKENDS = [('json', make_json_dumps())]
+if simplejson is not None:
+    BACKENDS.insert(0, ('simplejson', simplejson.JSONEncoder(default=default).encode))
+if orjson is not None:
+    BACKENDS.insert(0, ('orjson', dumps_orjson))
+
+backend, dumps = BACKENDS[0]
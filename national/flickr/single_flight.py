@@ -0,0 +1,136 @@
+"""
+Coalescing of identical requests.
+Several scrapers and pipelines in a process often ask for the same URL at
+about the same time: the national pipelines query the same API for each
+metro, and Socrata metadata is fetched by every scraper that uses a
+dataset. SingleFlight makes the first caller of a given request do the work
+while any identical requests that arrive before it's done wait for it and
+share its result, and keeps the result for a few seconds afterward for
+latecomers. Only GETs should be coalesced, and the key must include every
+header that can change the response, such as cookies.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import access_log
+
+
+class Call(object):
+    "A request in flight, and then its result or exception."
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.expires = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # Maps key to Call.
+        self.num_shared = 0
+
+    def do(self, key, fn, ttl=0, cacheable=None):
+        """
+        Returns a tuple of (fn(), shared). If a call with the same key is in
+        flight, waits for it and returns its result (or raises its
+        exception) with shared set to True, instead of calling fn. A result
+        is also shared for `ttl` seconds after it arrives, if
+        cacheable(result) is true or `cacheable` is None. Exceptions are
+        only shared with callers that were already waiting.
+        """
+        now = time.time()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None and call.expires is not None and call.expires <= now:
+                del self.calls[key]
+                call = None
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.done.wait()
+            with self.lock:
+                self.num_shared += 1
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result, True
+        try:
+            call.result = fn()
+        except:
+            call.exc_info = sys.exc_info()
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+            raise
+        with self.lock:
+            if ttl and (cacheable is None or cacheable(call.result)):
+                call.expires = time.time() + ttl
+                self.prune()
+            else:
+                del self.calls[key]
+        call.done.set()
+        return call.result, False
+
+    def prune(self):
+        "Forgets expired results. Must be called with the lock held."
+        now = time.time()
+        for key, call in self.calls.items():
+            if call.expires is not None and call.expires <= now:
+                del self.calls[key]
+
+    def clear(self):
+        "Forgets every result that's been kept."
+        with self.lock:
+            for key, call in self.calls.items():
+                if call.expires is not None:
+                    del self.calls[key]
+
+
+_group = None
+_group_pid = None
+_group_lock = threading.Lock()
+
+def get_group():
+    "Returns the process-wide SingleFlight, a new one in each forked process."
+    global _group, _group_pid
+    with _group_lock:
+        if _group is None or _group_pid != os.getpid():
+            _group = SingleFlight()
+            _group_pid = os.getpid()
+        return _group
+
+
+def request_key(method, uri, headers=None, *extra):
+    """
+    Returns a key identifying a request by its method, URI and headers
+    (case-insensitively), plus anything else in `extra` that changes the
+    response.
+    """
+    headers = tuple(sorted((k.lower(), v) for k, v in (headers or {}).items()))
+    return (method, uri, headers) + extra
+
+def coalesce(fn, method, uri, headers=None, ttl=0, get_status=None, source=None, extra=()):
+    """
+    Returns a tuple of (fn(), shared), sharing the result of an identical
+    request in flight or made in the last `ttl` seconds; see
+    SingleFlight.do(). get_status(result) returns the response's status.
+    Any response is shared with callers that were waiting for it, but only
+    2xx and 3xx responses are kept after that, so that an error or a
+    throttling response like a 429 isn't handed to requests made after it
+    arrived. Without get_status, nothing is kept. Shared results are
+    recorded in the access log with cache='shared', since they didn't make
+    a request of their own.
+    """
+    def cacheable(result):
+        return 200 <= int(get_status(result)) < 400
+    start = time.time()
+    result, shared = get_group().do(request_key(method, uri, headers, *extra), fn,
+        ttl if get_status else 0, cacheable)
+    if shared:
+        access_log.record(method, uri, get_status(result) if get_status else None,
+            time.time() - start, cache='shared', source=source)
+    return result, shared
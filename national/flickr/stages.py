@@ -10,14 +10,40 @@ import xmltodict
 import icalendar
 import feedparser
 
+import fetcher
+
 
 class PipelineStage(object):
     step_returns_context_manager = False
 
-    def __init__(self, input_key=None, output_key=None):
+    # Number of step() calls to run at once on a pool of threads, for stages
+    # that spend their time waiting on the network. At most 2 * concurrency
+    # items are taken from the previous stage before their results have
+    # been passed on. Results come out in the order the items came in
+    # unless ordered is False, and if per_host is set, no more than that
+    # many of the calls are for the same host (the input must be a URL).
+    # Stages whose step() is safe to run on several threads at once set
+    # async_safe, and Pipeline.get_values_async() runs them with its
+    # concurrency unless they set their own. All of these can also be given
+    # to the constructor.
+    concurrency = 1
+    ordered = True
+    per_host = None
+    async_safe = False
+
+    def __init__(self, input_key=None, output_key=None, concurrency=None, ordered=None,
+            per_host=None, async_safe=None):
         self.pipeline = None
         self.input_key = input_key
         self.output_key = output_key
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if async_safe is not None:
+            self.async_safe = async_safe
+        if ordered is not None:
+            self.ordered = ordered
+        if per_host is not None:
+            self.per_host = per_host
 
     def as_generator_func(self, pipeline):
         self.pipeline = pipeline
@@ -28,25 +54,45 @@ class PipelineStage(object):
 
     def run(self, source):
         if self.step_returns_context_manager:
-            for data in source:
-                obj = self.step(data)
+            for data, obj in self.steps(source):
                 with obj:
                     yield obj
         else:
-            for data in source:
-                yield self.step(data)
+            for data, obj in self.steps(source):
+                yield obj
 
     def run_with_dicts(self, source):
+        get_input = lambda dic: dic[self.input_key]
         if self.step_returns_context_manager:
-            for dic in source:
-                dic[self.output_key] = self.step(dic[self.input_key])
+            for dic, obj in self.steps(source, get_input):
+                dic[self.output_key] = obj
                 with dic[self.output_key]:
                     yield dic
         else:
-            for dic in source:
-                dic[self.output_key] = self.step(dic[self.input_key])
+            for dic, obj in self.steps(source, get_input):
+                dic[self.output_key] = obj
                 yield dic
 
+    def steps(self, source, get_input=None):
+        """
+        Yields (item, self.step(get_input(item))) for each item from the
+        previous stage, running the steps concurrently if concurrency is
+        more than 1. In debug mode, steps run one at a time, because the
+        request cache can only be used from one thread.
+        """
+        get_input = get_input or (lambda item: item)
+        if self.concurrency <= 1 or getattr(self.pipeline, 'debug', False):
+            for item in source:
+                yield item, self.step(get_input(item))
+            return
+        if self.per_host:
+            host = lambda item: fetcher.request_host(get_input(item))
+        else:
+            host = lambda item: None
+        for item, obj in fetcher.fetch_all(lambda item: self.step(get_input(item)), source,
+                self.concurrency, self.per_host, self.ordered, host):
+            yield item, obj
+
     def step(self, obj):
         raise NotImplementedError
 
@@ -59,12 +105,47 @@ class Flatten(PipelineStage):
 
 
 class Download(PipelineStage):
+    async_safe = True
+
     def step(self, url):
         return self.pipeline.get(url).text
 
 
+class DownloadAll(Download):
+    """
+    Like Download, but fetches 8 URLs at once by default. See
+    PipelineStage.concurrency.
+    """
+    def __init__(self, concurrency=8, per_host=None, ordered=True, *args, **kwargs):
+        super(DownloadAll, self).__init__(concurrency=concurrency, ordered=ordered,
+            per_host=per_host, *args, **kwargs)
+
+
+class Map(PipelineStage):
+    """
+    Calls a function on each item, like a plain function stage, dropping
+    None results. It's for running a function concurrently:
+        stages.Map(self.download_and_wait, concurrency=4)
+    or, with get_values_async(), if the function is safe to run on several
+    threads at once:
+        stages.Map(self.download_and_wait, async_safe=True)
+    """
+    def __init__(self, func, *args, **kwargs):
+        super(Map, self).__init__(*args, **kwargs)
+        self.func = func
+
+    def run(self, source):
+        for data, value in self.steps(source):
+            if value is not None:
+                yield value
+
+    def step(self, data):
+        return self.func(data)
+
+
 class DownloadFile(PipelineStage):
     step_returns_context_manager = True
+    async_safe = True
 
     def step(self, url):
         return self.pipeline.get_to_file(url)
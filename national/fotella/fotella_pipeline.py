@@ -53,7 +53,8 @@ class Pipeline(sundew_pipeline.Pipeline):
     def get_stages(self):
         return [
             self.get_list_urls,
-            stages.Download,
+            # The API calls for each centroid are independent.
+            stages.DownloadAll(concurrency=8, ordered=False),
             self.check_response,
             stages.ParseJson,
             self.get_final,
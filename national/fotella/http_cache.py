@@ -0,0 +1,106 @@
+"""
+Conditional GET cache for large files.
+Keeps the last copy of each downloaded file on disk, along with the ETag and
+Last-Modified headers the server sent with it. The next request for the
+same URL sends them back as If-None-Match and If-Modified-Since, and if the
+server answers 304 Not Modified, the copy on disk is used instead of
+downloading the whole file again.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class CacheEntry(object):
+    def __init__(self, filename, etag=None, last_modified=None):
+        self.filename = filename
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def validators(self):
+        "Returns the request headers that ask for the file only if it has changed."
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = str(self.etag)
+        if self.last_modified:
+            headers['If-Modified-Since'] = str(self.last_modified)
+        return headers
+
+
+class ConditionalCache(object):
+    """
+    Stores files in `directory`, named after a hash of their URLs. Each file
+    has a .json file next to it that holds its URL and validators.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def get_paths(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        key = hashlib.sha1(url).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path, path + '.json'
+
+    def get(self, url):
+        "Returns the CacheEntry for the given URL, or None."
+        filename, meta_filename = self.get_paths(url)
+        try:
+            with open(meta_filename) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(filename):
+            return None
+        return CacheEntry(filename, meta.get('etag'), meta.get('last_modified'))
+
+    def set(self, url, filename, resp_headers):
+        """
+        Moves the file a response for the given URL was downloaded to into
+        the cache, if the response has validators, and returns its
+        CacheEntry. Returns None and leaves the file alone if the server
+        didn't send an ETag or Last-Modified, since there'd be no way to ask
+        it whether the file had changed.
+        """
+        etag = resp_headers.get('etag')
+        last_modified = resp_headers.get('last-modified')
+        if not (etag or last_modified):
+            return None
+        cache_filename, meta_filename = self.get_paths(url)
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write both files somewhere else in the directory first and then
+            # rename them, so that an interrupted move never leaves a partial
+            # file that looks complete. The metadata goes last, since get()
+            # checks it first.
+            fd, tmp_filename = tempfile.mkstemp(dir=self.directory)
+            os.close(fd)
+            shutil.move(filename, tmp_filename)
+            os.rename(tmp_filename, cache_filename)
+            self.write_atomic(meta_filename, json.dumps({
+                'url': url,
+                'etag': etag,
+                'last_modified': last_modified,
+            }))
+        return CacheEntry(cache_filename, etag, last_modified)
+
+    def write_atomic(self, filename, content):
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(content)
+            os.rename(tmp_filename, filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+
+    def delete(self, url):
+        for filename in self.get_paths(url):
+            if os.path.exists(filename):
+                os.unlink(filename)
@@ -4,6 +4,10 @@ from django.db import transaction
 import json
 from django.utils.html import strip_tags
 import text as text_utils
+import sinks
+import record_index
+from checkpoint import Checkpoint
+import watermark
 from lxml import etree
 import urlparse
 import datetime
@@ -12,11 +16,29 @@ import os
 import re
 import sys
 import traceback
+import threading
+import Queue
 import ftplib
-from cStringIO import StringIO
+import contextlib
+import resource
+import itertools
+import copy
+import shutil
+import cProfile
+import pstats
 import time
 from dateutil.parser import parse as duparse
 import httplib2
+import http_pool
+import fetcher
+import retries
+import rate_limit
+import http_cache
+import streaming
+import ftp_pool
+import single_flight
+import mirror
+import access_log
 import socket
 from Cookie import SimpleCookie, CookieError
 
@@ -73,6 +95,16 @@ Results = namedtuple('Results', [
     'traceback',
     'num_geocode_succeeded',
     'num_geocode_attempted',
+    'timings',              # {phase: seconds}
+    'call_counts',          # {phase: number of calls}
+    'num_requests',
+    'num_not_modified',     # Downloads skipped because of a 304 response.
+    'num_coalesced',        # GETs answered with an identical request's response.
+    'num_mirrored',         # GETs answered from the local mirror.
+    'bytes_downloaded',     # Bytes received, compressed or not.
+    'bytes_decoded',        # Bytes after decompression.
+    'records_per_second',
+    'peak_rss',             # Peak resident set size of the process, in KB.
 ])
 
 class ScraperBroken(Exception):
@@ -81,10 +113,23 @@ class ScraperBroken(Exception):
 class ScraperCodeError(Exception):
     pass
 
+class RetrievalError(Exception):
+    "Couldn't retrieve data"
+    pass
+
+class PageNotFoundError(RetrievalError):
+    "Couldn't retrieve data"
+    pass
+
 class Scraper(object):
     primary_key = UNDEFINED # Set to None if the scraper should never look for existing records.
     schema = None
-    sleep = 0
+    # Maximum number of requests a second to any one host, or None for no
+    # limit, and how many requests may be made at once before the limit kicks
+    # in. The limit is shared with every other scraper in the process that
+    # uses the same host. See rate_limit.RateLimiter.
+    rate_limit = None
+    rate_burst = 1
     timeout = 20
     update = True # Whether to update old records.
 
@@ -107,18 +152,115 @@ class Scraper(object):
     #   "News at {street_number} {street_name} {street_suffix}"
     title_format = u'{title}'
 
+    # Where run() writes saved records. By default this is newline-delimited
+    # JSON in <schema>-data.txt, flushed every sink_flush_every records.
+    sink_class = sinks.NDJsonSink
+    sink_flush_every = 1000
+    sink_compress = False
+
+    # If True, save() looks up each record's primary_key in an on-disk index
+    # and skips records that haven't changed since the last successful run.
+    # Fields in index_ignore_fields don't count as changes.
+    skip_unchanged = True
+    record_index_path = 'record-index.sqlite'
+    index_ignore_fields = ('pub_date',)
+
+    # If set, run() saves records with save_batch(), which hands prepared
+    # records to create_newsitems() in chunks of this size.
+    batch_size = None
+
+    # If num_workers is set, run() pulls records from data() in a producer
+    # thread and saves them in that many worker threads. At most queue_size
+    # records are in flight at once. If preserve_order is True, saved records
+    # reach the sink in the order data() yielded them.
+    num_workers = 0
+    queue_size = 100
+    preserve_order = False
+
+    # If checkpoint is True, a run() that fails part way through can be
+    # picked up again by the next run(). data() should start from
+    # resume_cursor() (None on a fresh run) and call save_checkpoint() once
+    # everything up to a given point has been yielded. Checkpoints are only
+    # taken when records are saved one at a time.
+    checkpoint = False
+    checkpoint_path = None # Defaults to <output file>-checkpoint.json.
+    checkpoint_counters = ('num_added', 'num_changed', 'num_skipped',
+        'num_geocode_attempted', 'num_geocode_succeeded')
+
+    # After every successful run(), the latest value of watermark_field seen
+    # is saved for this scraper's metro and schema. data() can then call
+    # since_watermark() to fetch only what's new, going back
+    # watermark_overlap further to catch late-arriving records. metro
+    # defaults to the name of the scraper's directory.
+    watermark_field = 'item_date'
+    watermark_path = 'watermarks.sqlite'
+    watermark_overlap = datetime.timedelta(days=2)
+    metro = None
+
+    # How get_html_and_headers() retries failed requests. circuit_breaker is
+    # shared by every scraper in the process unless it's overridden.
+    retry_policy = retries.RetryPolicy()
+    circuit_breaker = retries.circuit_breaker
+
+    # fetch_all() makes up to fetch_concurrency requests at once, and no more
+    # than fetch_per_host to the same host.
+    fetch_concurrency = 8
+    fetch_per_host = 4
+
+    # cache_get_to_file() keeps the last copy of every file it downloads in
+    # this directory, and downloads it again only if the server says it has
+    # changed. Set to None to always download.
+    http_cache_dir = 'http-cache'
+
+    # download() keeps the raw body of every GET in partial_dir until all of
+    # it has arrived, so a download that's cut off, even in an earlier run,
+    # resumes with a Range request instead of starting over. Set to None to
+    # always start over. Files of at least download_part_size bytes are
+    # fetched as up to download_parts byte ranges at once.
+    partial_dir = 'partial-downloads'
+    download_parts = 1
+    download_part_size = 16 * 1024 * 1024
+
+    # ftp:// URIs are downloaded with logged-in connections shared by every
+    # scraper in the process (see ftp_pool), in passive mode unless
+    # ftp_passive is False. Several files can be fetched at once with
+    # fetch_all(uris, fetch=self.get_to_file).
+    ftp_passive = True
+
+    # get_html_and_headers() GETs that are identical to one in flight, or
+    # to one that got a 2xx or 3xx response in the last coalesce_ttl
+    # seconds, in this or any other scraper in the process, share its
+    # response instead of making the request again. Set to None to always make the request.
+    coalesce_ttl = 5
+
+    # When dry_run(profile=True) is profiling, time spent in each timed()
+    # phase is attributed to one of these report sections.
+    profile_sections = {
+        'http': 'download',
+        'data': 'parse',
+        'prepare_data': 'prepare',
+        'geocode': 'prepare',
+    }
+
     def __init__(self, retriever=None):
         self.retriever = retriever
         self.logger = logging.getLogger('start fetching data')
         #self._geocoder = SmartGeocoder()
         self.clear_cache()
-        self.h = httplib2.Http(timeout=20, disable_ssl_certificate_validation=True)
+        # Connections are shared with every other scraper in the process.
+        self.h = http_pool.PooledHttp(timeout=20, disable_ssl_certificate_validation=True)
         self.user_agent = 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.0)'
         self._cookies = SimpleCookie()
         self.scraper_name = None
         self.is_dry_run = False
         self.num_geocode_attempted = 0
         self.num_geocode_succeeded = 0
+        self.record_index = None
+        self._sink = self._checkpoint = self._resume_state = None
+        self.latest_seen = None
+        self._counter_lock = threading.Lock()
+        self._profilers = self._active_profiler = None
+        self.reset_stats()
 
     def clear_cache(self):
         self._metro_object_cache = None
@@ -138,7 +280,8 @@ class Scraper(object):
         """
         pass
 
-    def dry_run(self, prepare=False, save_ungeocoded_addresses=False):
+    def dry_run(self, prepare=False, save_ungeocoded_addresses=False,
+            profile=False, limit=None, sample_every=None, top=15):
         """
         Run the scraper, but do not create or update any NewsItem objects.
         If `prepare` is True, this method will geocode location_names and create
@@ -146,29 +289,50 @@ class Scraper(object):
         If `save_ungeocoded_addresses` is a string value, the string will be
         treated as a file path, and all addresses that fail to be geocoded
         will be saved into that file.
+        If `profile` is True, records aren't printed. Instead the scraper runs
+        under cProfile, the stats are dumped to <schema>-dry-run.prof and the
+        `top` hottest functions of the download, parse and prepare phases are
+        printed. See dry_run_iter() for `limit` and `sample_every`.
         """
-        for item in self.dry_run_iter(prepare, save_ungeocoded_addresses):
-            pass
+        if profile:
+            self.start_profiling()
+        try:
+            for item in self.dry_run_iter(prepare, save_ungeocoded_addresses,
+                    limit=limit, sample_every=sample_every, verbose=not profile):
+                pass
+        finally:
+            if profile:
+                print self.stop_profiling(self.schema + '-dry-run.prof', top)
 
-    def dry_run_iter(self, prepare=False, save_ungeocoded_addresses=False):
+    def dry_run_iter(self, prepare=False, save_ungeocoded_addresses=False,
+            limit=None, sample_every=None, verbose=True):
         """
         Just like dry_run(), but returns a generator that iterates over the
         data dictionaries created.
+        Only the first `limit` records from data() are read, and if
+        `sample_every` is set, only every sample_every-th record is prepared
+        and yielded. Records are only printed if `verbose` is True.
         """
         import pprint
         self.is_dry_run = True
         self.cache_retriever = CacheRetriever(self)
         self.start_time = datetime.datetime.now()
         self.start_date = self.start_time.date()
+        self.reset_stats()
         if save_ungeocoded_addresses:
             self.ungeocoded_addresses = {}
             self.geocode = self.geocode_and_log
 
         try:
-            for datadict in self.data():
+            data = itertools.islice(self.timed_iter('data', self.data()), limit)
+            for i, datadict in enumerate(data):
+                if sample_every and i % sample_every:
+                    continue
                 if prepare:
-                    datadict = self.prepare_data(datadict)
-                pprint.pprint(datadict)
+                    with self.timed('prepare_data'):
+                        datadict = self.prepare_data(datadict)
+                if verbose:
+                    pprint.pprint(datadict)
                 yield datadict
         finally:
             self.clear_cache()
@@ -177,24 +341,180 @@ class Scraper(object):
         if save_ungeocoded_addresses:
             self.create_geocoding_report()
 
-    def run(self, raise_errors=True):
+    def get_sink(self, filename):
+        """
+        Returns the sink that run() writes saved records to. Override this (or
+        sink_class) to send records somewhere other than a local file.
+        """
+        return self.sink_class(filename, flush_every=self.sink_flush_every,
+            compress=self.sink_compress)
+
+    def get_record_index(self):
+        """
+        Returns the RecordIndex that save() uses to skip unchanged records, or
+        None if this scraper doesn't have a usable primary_key.
+        """
+        if not self.skip_unchanged or self.primary_key in (None, UNDEFINED):
+            return None
+        return record_index.RecordIndex(self.record_index_path, self.schema)
+
+    def get_checkpoint(self, filename):
+        """
+        Returns the Checkpoint for a run() writing to the given file, or None
+        if checkpointing is off.
+        """
+        if not self.checkpoint:
+            return None
+        if self.num_workers or self.batch_size:
+            # Records yielded before a checkpoint could still be in flight.
+            self.logger.warning('Checkpoints are disabled when num_workers or batch_size is set')
+            return None
+        return Checkpoint(self.checkpoint_path or os.path.splitext(filename)[0] + '-checkpoint.json')
+
+    def start_checkpoint(self, filename, sink):
+        """
+        Loads the checkpoint left by a failed run, if any, and restores the
+        output written and counters as of that checkpoint.
+        """
+        self._sink = sink
+        self._checkpoint = self.get_checkpoint(filename)
+        self._resume_state = None
+        if self._checkpoint is None:
+            return
+        # Keep what's been written if this run fails too.
+        sink.keep_partial = True
+        state = self._checkpoint.load()
+        if state is None:
+            return
+        if not sink.resume(state['sink_offset'], state['num_written']):
+            self.logger.warning('%s is missing or incomplete, ignoring checkpoint %r',
+                sink.temp_filename, state['cursor'])
+            return
+        self.logger.info('Resuming from checkpoint %r', state['cursor'])
+        for name in self.checkpoint_counters:
+            setattr(self, name, state.get(name, 0))
+        self._resume_state = state
+
+    def resume_cursor(self):
+        "Returns the cursor of the checkpoint run() resumed from, or None."
+        if self._resume_state is None:
+            return None
+        return self._resume_state['cursor']
+
+    def save_checkpoint(self, cursor):
+        """
+        Records that data() has yielded everything up to and including
+        `cursor`, which must be JSON-serializable (dates are OK). A later run
+        will resume from there. Does nothing if checkpointing is off.
+        """
+        if self._checkpoint is None:
+            return
+        state = dict((name, getattr(self, name)) for name in self.checkpoint_counters)
+        state.update(cursor=cursor, sink_offset=self._sink.checkpoint(),
+            num_written=self._sink.num_written)
+        if self.record_index is not None:
+            self.record_index.commit()
+        self._checkpoint.save(state)
+
+    def get_metro(self):
+        "Returns the metro that this scraper's watermark is stored under."
+        if self.metro is not None:
+            return self.metro
+        module = sys.modules[self.__module__]
+        return os.path.basename(os.path.dirname(os.path.abspath(module.__file__)))
+
+    def get_source(self):
+        "Returns the name this scraper's requests are logged under, e.g. 'boston/CrimeScraper'."
+        return '%s/%s' % (self.get_metro(), type(self).__name__)
+
+    def get_watermark(self):
+        "Returns the watermark saved by the last successful run, or None."
+        store = watermark.WatermarkStore(self.watermark_path)
+        try:
+            return store.get(self.get_metro(), self.schema)
+        finally:
+            store.close()
+
+    def since_watermark(self, days):
+        """
+        Returns the date (or datetime) that data() should fetch records from:
+        the watermark minus watermark_overlap, or `days` days before today if
+        there's no watermark or it's older than that. A scraper that used to
+        fetch a fixed 90-day window can pass days=90.
+        """
+        since = self.start_date - datetime.timedelta(days=days)
+        value = self.get_watermark()
+        if value is not None and watermark.is_later(value - self.watermark_overlap, since):
+            since = value - self.watermark_overlap
+        return since
+
+    def observe_watermark(self, datadict):
+        "Updates latest_seen with the watermark_field of the given record."
+        value = datadict.get(self.watermark_field)
+        if not isinstance(value, datetime.date):
+            return
+        value = watermark.normalize(value)
+        with self._counter_lock:
+            if self.latest_seen is None or watermark.is_later(value, self.latest_seen):
+                self.latest_seen = value
+
+    def save_watermark(self):
+        "Saves latest_seen as the watermark for the next run."
+        if self.latest_seen is None:
+            return
+        store = watermark.WatermarkStore(self.watermark_path)
+        try:
+            value = store.set(self.get_metro(), self.schema, self.latest_seen)
+        finally:
+            store.close()
+        self.logger.info('Watermark: %s', value)
+
+    def get_primary_key(self, datadict):
+        "Returns the values of the primary_key fields for the given record."
+        return tuple(datadict.get(name) for name in self.primary_key)
+
+    def run(self, raise_errors=True, sink=None):
+        """
+        Saves every record yielded by data(), streaming each one to `sink` as
+        it's saved. If `sink` is None, get_sink() is used.
+        """
         self.logger.info("run() started")
-        self.num_added = self.num_changed = 0
+        self.num_added = self.num_changed = self.num_skipped = 0
+        self.latest_seen = None
+        self.reset_stats()
         self.start_time = datetime.datetime.now()
         self.start_date = self.start_time.date()
         # We use a try/finally here so that the DataUpdate object is created
         # regardless of whether the scraper raised an exception.
         results = None
+        records = None
 
-	filename = 'schoolreviews-data.txt'
-	ni = []
+        filename = 'schoolreviews-data.txt'
+        if sink is None:
+            sink = self.get_sink(filename)
+        self.record_index = self.get_record_index()
+        self.start_checkpoint(filename, sink)
         try:
             got_error = True
-            for datadict in self.data():
-                ni.append(self.save(datadict))
+            data = self.timed_iter('data', self.data())
+            if self.num_workers:
+                records = self.save_concurrently(data)
+            elif self.batch_size:
+                records = self.save_batch(data)
+            else:
+                records = (self.save(datadict) for datadict in data)
+            for record in records:
+                if record is not None:
+                    with self.timed('output'):
+                        sink.write(record)
+            with self.timed('output'):
+                sink.commit()
+            if self.record_index is not None:
+                self.record_index.commit()
+            if self._checkpoint is not None:
+                self._checkpoint.clear()
+            self.save_watermark()
             got_error = False
- 	    with open(filename, 'w+') as outfile:
-                json.dump(ni, outfile)
 
         except:
             # Record exceptions in the finally block
@@ -204,12 +524,21 @@ class Scraper(object):
                 pass
         finally:
             exc_type, exc_value, exc_traceback = sys.exc_info()
+            # Close the record generator, so that save_concurrently() has
+            # stopped its workers before the sink and the index are closed.
+            if records is not None and hasattr(records, 'close'):
+                records.close()
             # Rollback, in case the database is in an aborted transaction. This
             # avoids the "psycopg2.ProgrammingError: current transaction is aborted,
             # commands ignored until end of transaction block" error.
 #            from django.db import connection
  #           connection._rollback()
             finish_time = datetime.datetime.now()
+            sink.close()
+            self._sink = self._checkpoint = self._resume_state = None
+            if self.record_index is not None:
+                self.record_index.close()
+                self.record_index = None
             self.clear_cache()
 
             results = Results(schema=self.schema,
@@ -217,19 +546,154 @@ class Scraper(object):
                 update_finish=finish_time,
                 num_added=self.num_added,
                 num_changed=self.num_changed,
-                num_skipped=0,
+                num_skipped=self.num_skipped,
                 num_hidden=0,
                 got_error=got_error,
                 traceback=''.join([x for x in traceback.format_exception(exc_type, exc_value, exc_traceback)]),
                 num_geocode_succeeded=self.num_geocode_succeeded,
                 num_geocode_attempted=self.num_geocode_attempted,
+                timings=self.get_timings(),
+                call_counts=dict(self.call_counts),
+                num_requests=self.num_requests,
+                num_not_modified=self.num_not_modified,
+                num_coalesced=self.num_coalesced,
+                num_mirrored=self.num_mirrored,
+                bytes_downloaded=self.bytes_downloaded,
+                bytes_decoded=self.bytes_decoded,
+                records_per_second=self.get_records_per_second(finish_time),
+                peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
             )
+            self.write_stats(os.path.splitext(filename)[0] + '-stats.json', results)
 
             self.logger.info('Records added: %s', self.num_added)
             self.logger.info('Records changed: %s', self.num_changed)
+            self.logger.info('Records skipped: %s', self.num_skipped)
             self.logger.info('Geocoding succeeded/attempted: {0}/{1}'.format(self.num_geocode_succeeded, self.num_geocode_attempted))
+            self.logger.info('Requests: %s (%s bytes)', self.num_requests, self.bytes_downloaded)
+            self.logger.info('Time by phase: %s', ', '.join('%s=%.2fs' % item for item in sorted(results.timings.items())))
         return results
 
+    def reset_stats(self):
+        """
+        Resets the per-phase timing and throughput counters reported in
+        Results.
+        """
+        self.timings = defaultdict(float)
+        self.call_counts = defaultdict(int)
+        self.num_requests = 0
+        self.num_not_modified = 0
+        self.num_coalesced = 0
+        self.num_mirrored = 0
+        self.bytes_downloaded = 0
+        self.bytes_decoded = 0
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """
+        Context manager that adds the wall time spent inside it to the given
+        phase (e.g. 'http', 'prepare_data', 'geocode').
+        """
+        start = time.time()
+        previous_profiler = self._switch_profiler(phase)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if self._profilers is not None:
+                self._set_profiler(previous_profiler)
+            with self._counter_lock:
+                self.timings[phase] += elapsed
+                self.call_counts[phase] += 1
+
+    def timed_iter(self, phase, iterable):
+        "Yields from iterable, timing each step under the given phase."
+        iterator = iter(iterable)
+        while True:
+            with self.timed(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def get_timings(self):
+        """
+        Returns a dictionary of seconds spent in each phase. 'parse' is the
+        time spent in data() that wasn't spent on HTTP requests.
+        """
+        timings = dict(self.timings)
+        if 'data' in timings:
+            timings['parse'] = max(0.0, timings['data'] - timings.get('http', 0.0))
+        return timings
+
+    def start_profiling(self):
+        """
+        Starts profiling timed() phases, with one profiler for each of the
+        sections in profile_sections.
+        """
+        sections = set(self.profile_sections.values())
+        self._profilers = dict((section, cProfile.Profile()) for section in sections)
+        self._active_profiler = None
+
+    def _switch_profiler(self, phase):
+        """
+        Makes the profiler for the given phase's section the active one, and
+        returns the profiler that was active before. Phases that aren't in
+        profile_sections are counted under whatever section they're nested in.
+        """
+        previous = self._active_profiler
+        if self._profilers is not None and phase in self.profile_sections:
+            self._set_profiler(self._profilers[self.profile_sections[phase]])
+        return previous
+
+    def _set_profiler(self, profiler):
+        if self._active_profiler is not None:
+            self._active_profiler.disable()
+        self._active_profiler = profiler
+        if profiler is not None:
+            profiler.enable()
+
+    def stop_profiling(self, filename, top=15):
+        """
+        Stops profiling, dumps the combined stats of every section to
+        `filename` (readable with the pstats module) and returns a report of
+        the time spent in each section and its `top` hottest functions.
+        """
+        self._set_profiler(None)
+        profilers, self._profilers = self._profilers, None
+        lines = []
+        used = []
+        for section in sorted(profilers):
+            profiler = profilers[section]
+            profiler.create_stats()
+            if not profiler.stats:
+                lines.append('%s: 0.00s' % section)
+                continue
+            used.append(profiler)
+            # stats maps (file, line, function) to
+            # (primitive calls, calls, own time, cumulative time, callers).
+            stats = pstats.Stats(profiler).stats
+            lines.append('%s: %.2fs' % (section, sum(value[2] for value in stats.values())))
+            hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+            for (file_name, line, func), (cc, nc, tt, ct, callers) in hottest:
+                lines.append('  %8.3fs %8.3fs %8d  %s:%s(%s)' % (tt, ct, nc,
+                    os.path.basename(file_name), line, func))
+        if used:
+            pstats.Stats(*used).dump_stats(filename)
+            lines.append('Profile written to %s' % filename)
+        return '\n'.join(lines)
+
+    def get_records_per_second(self, finish_time):
+        elapsed = (finish_time - self.start_time).total_seconds()
+        num_records = self.num_added + self.num_changed + self.num_skipped
+        return num_records / elapsed if elapsed else 0.0
+
+    def write_stats(self, filename, results):
+        "Saves the given Results as JSON, for tracking scraper performance."
+        stats = results._asdict()
+        with open(filename, 'w') as fp:
+            json.dump(stats, fp, indent=2, default=str)
+
     def prepare_data(self, datadict):
         # Get/create Lookup objects for lookup fields and set the value to the
         # Lookup ID.
@@ -260,7 +724,26 @@ class Scraper(object):
         return datadict
 
     def save(self, datadict):
-        datadict = self.prepare_data(datadict)
+        datadict, status = self.prepare_for_save(datadict)
+        if status == record_index.UNCHANGED:
+            return None
+        with self.timed('create'):
+            ni = self.create_newsitem(datadict)
+        self.count_saved(status)
+ #       self.logger.info(u'Created NewsItem %s (total created in this scrape: %s)', ni.id, self.num_added)
+#        self.created_newsitem_ids.append(ni.id)
+        return ni
+
+    def prepare_for_save(self, datadict):
+        """
+        Prepares the given record for saving and checks it against the record
+        index. Returns a tuple of (datadict, status), where status is one of
+        record_index.ADDED, CHANGED or UNCHANGED.
+        """
+        with self.timed('prepare_data'):
+            datadict = self.prepare_data(datadict)
+        if self.item_date_available or self.watermark_field != 'item_date':
+            self.observe_watermark(datadict)
         #if datadict['location'] is None:
          #   return
         old_newsitem = None
@@ -273,22 +756,167 @@ class Scraper(object):
                 datadict['item_date'] = datetime.date.today()
             else:
                 datadict['item_date'] = old_newsitem.item_date
-        ni = self.create_newsitem(datadict)
-        self.num_added += 1
- #       self.logger.info(u'Created NewsItem %s (total created in this scrape: %s)', ni.id, self.num_added)
-#        self.created_newsitem_ids.append(ni.id)
-        return ni
+
+        status = record_index.ADDED
+        if self.record_index is not None:
+            ignore_fields = self.index_ignore_fields
+            if not self.item_date_available:
+                ignore_fields += ('item_date',)
+            status = self.record_index.check(self.get_primary_key(datadict), datadict, ignore_fields)
+            if status == record_index.UNCHANGED:
+                self.increment('num_skipped')
+        return datadict, status
+
+    def count_saved(self, status):
+        if status == record_index.CHANGED:
+            self.increment('num_changed')
+        else:
+            self.increment('num_added')
+
+    def increment(self, counter, amount=1):
+        """
+        Adds `amount` to the given counter attribute (e.g. 'num_added'). This
+        is safe to call from save_concurrently() worker threads.
+        """
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def save_batch(self, datadicts, batch_size=None):
+        """
+        Like save(), but for an iterable of records. Prepared records are
+        collected and passed to create_newsitems() `batch_size` at a time
+        (self.batch_size by default). Yields each created NewsItem.
+        """
+        batch_size = batch_size or self.batch_size or 1
+        batch = []
+        for datadict in datadicts:
+            datadict, status = self.prepare_for_save(datadict)
+            if status == record_index.UNCHANGED:
+                continue
+            batch.append((datadict, status))
+            if len(batch) >= batch_size:
+                for ni in self.flush_batch(batch):
+                    yield ni
+                batch = []
+        if batch:
+            for ni in self.flush_batch(batch):
+                yield ni
+
+    def flush_batch(self, batch):
+        "Creates NewsItems for a list of (datadict, status) pairs."
+        with self.timed('create'):
+            newsitems = self.create_newsitems([datadict for datadict, status in batch])
+        for datadict, status in batch:
+            self.count_saved(status)
+        self.logger.debug('Saved a batch of %s records (total added in this scrape: %s)', len(batch), self.num_added)
+        return newsitems
+
+    def save_concurrently(self, datadicts, num_workers=None, preserve_order=None):
+        """
+        Calls save() on each record in a pool of `num_workers` threads while a
+        producer thread pulls records from `datadicts`. Yields the return value
+        of each save() call, in input order if `preserve_order` is True. At
+        most self.queue_size records are in flight at a time.
+        If `datadicts` or save() raises an exception, it's re-raised here with
+        its original traceback and the remaining records are dropped. When
+        the generator exits, for any reason, it waits for save() calls that
+        are in progress to finish.
+        """
+        num_workers = num_workers or self.num_workers
+        if preserve_order is None:
+            preserve_order = self.preserve_order
+        inputs = Queue.Queue()
+        outputs = Queue.Queue()
+        slots = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for i, datadict in enumerate(datadicts):
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    inputs.put((i, datadict))
+            except:
+                outputs.put((None, None, sys.exc_info()))
+            finally:
+                for _ in range(num_workers):
+                    inputs.put(None)
+
+        def work():
+            while True:
+                item = inputs.get()
+                if item is None:
+                    break
+                i, datadict = item
+                if stop.is_set():
+                    continue
+                try:
+                    outputs.put((i, self.save(datadict), None))
+                except:
+                    outputs.put((i, None, sys.exc_info()))
+            outputs.put(None)
+
+        threads = [threading.Thread(target=produce)]
+        threads += [threading.Thread(target=work) for _ in range(num_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_index = 0
+        workers_left = num_workers
+        try:
+            while workers_left:
+                item = outputs.get()
+                if item is None:
+                    workers_left -= 1
+                    continue
+                i, result, exc_info = item
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if not preserve_order:
+                    slots.release()
+                    yield result
+                    continue
+                pending[i] = result
+                while next_index in pending:
+                    slots.release()
+                    yield pending.pop(next_index)
+                    next_index += 1
+        finally:
+            stop.set()
+            # Wake up the producer in case it's waiting for a free slot.
+            for _ in range(self.queue_size):
+                slots.release()
+            # Stop the workers without waiting for the producer, which may be
+            # in the middle of a slow data() step, and wait for any save()
+            # that's in progress, since the caller closes the sink and the
+            # record index next.
+            for _ in range(num_workers):
+                inputs.put(None)
+            for thread in threads[1:]:
+                thread.join()
+
+    def create_newsitems(self, datadicts):
+        """
+        Creates NewsItems for a list of prepared records and returns them.
+        This is the hook save_batch() flushes each batch through, for a
+        scraper whose output can be written a batch at a time. By default it
+        calls create_newsitem() on each record.
+        """
+        return [self.create_newsitem(datadict) for datadict in datadicts]
 
     def create_newsitem(self, datadict):
         ni = {}#NewsItem.objects.create(
             #schema=self.schema_object,
-        ni['title']=datadict['title'],
-        ni['description']=datadict['description'],
-        ni['url']=datadict['url'],
-        ni['pub_date']=str(datadict['pub_date']),
-        ni['item_date']=str(datadict['item_date']),
-        ni['location_name']=datadict['location_name'],
-        ni['location_id']=None, # Scrapers shouldn't post to locations. In theory.
+        ni['title']=datadict['title']
+        ni['description']=datadict['description']
+        ni['url']=datadict['url']
+        ni['pub_date']=datadict['pub_date']
+        ni['item_date']=datadict['item_date']
+        ni['location_name']=datadict['location_name']
+        ni['location_id']=None # Scrapers shouldn't post to locations. In theory.
 	ni['location_name_geocoder'] = datadict['location_name_geocoder']
 	ni['review_id'] = datadict['review_id']
 	ni['school_name'] = datadict['school_name']
@@ -339,6 +967,16 @@ class Scraper(object):
         self._temp_files.append(filename) # Keep track so we can delete after scrape is done.
         return filename
 
+    def fetch_all(self, requests, fetch=None, ordered=True, host=fetcher.request_host):
+        """
+        Fetches many independent requests concurrently and yields (request,
+        result) tuples, in input order if `ordered` is True or as they
+        complete otherwise. `fetch` defaults to get(), so `requests` can just
+        be URLs. See fetcher.fetch_all().
+        """
+        return fetcher.fetch_all(fetch or self.get, requests, self.fetch_concurrency,
+            self.fetch_per_host, ordered, host)
+
     def cache_get(self, prefix, suffix, url, make_pretty=False, **kwargs):
         """
         Download the file at the given URL and return its contents as a string.
@@ -358,32 +996,119 @@ class Scraper(object):
         """
         if self.is_dry_run:
             return self.cache_retriever.get_to_file(prefix, suffix, url, **kwargs)
+        elif self.http_cache_dir and not kwargs.get('data'):
+            return self.conditional_get_to_file(url, **kwargs)
         else:
             return self.get_to_file(url, **kwargs)
 
+    def conditional_get_to_file(self, url, headers=None, **kwargs):
+        """
+        Downloads the given URL to a file in http_cache_dir and returns the
+        filename, unless the copy already there is still current. The copy's
+        ETag and Last-Modified are sent as If-None-Match and
+        If-Modified-Since, and a 304 response means the copy is used as is.
+        The file belongs to the cache, so it must not be modified or deleted.
+        If the server sends neither header, the file is downloaded to a
+        temporary file as usual.
+        """
+        cache = http_cache.ConditionalCache(self.http_cache_dir)
+        entry = cache.get(url)
+        headers = dict(headers or {})
+        if entry is not None:
+            headers.update(entry.validators())
+        filename, resp_headers = self.download(url, headers=headers, **kwargs)
+        if entry is not None and resp_headers['status'] == '304':
+            os.unlink(filename)
+            self.logger.info('%s has not changed; using %s', url, entry.filename)
+            self.increment('num_not_modified')
+            return entry.filename
+        new_entry = cache.set(url, filename, resp_headers)
+        if new_entry is not None:
+            return new_entry.filename
+        cache.delete(url)
+        return filename
+
     def get_to_file(self, *args, **kwargs):
         """
         Downloads the given URI and saves it to a temporary file. Returns the
         full filename of the temporary file.
         """
-        import os
+        return self.download(*args, **kwargs)[0]
+
+    def download(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
+        """
+        Like get_html_and_headers(), but streams the response body to a
+        temporary file instead of holding it in memory, and returns a tuple of
+        (filename, header dictionary). The response is requested with gzip or
+        deflate compression and decompressed on the fly, so bytes_downloaded
+        counts the bytes received and bytes_decoded the bytes written.
+        GET requests are resumable; see partial_dir. ftp:// URIs are
+        handed to ftp_download().
+        """
         from tempfile import mkstemp
+        import hashlib
+        if urlparse.urlsplit(uri).scheme == 'ftp':
+            return self.ftp_download(uri, headers, raise_on_error)
+        method, body, headers = self.prepare_request(data, headers, send_cookies, basic_auth)
+        entry = self.get_mirrored(uri) if method == 'GET' else None
+        if entry is not None:
+            fd, name = mkstemp()
+            os.close(fd)
+            shutil.copyfile(entry.filename, name)
+            return name, entry.resp_headers()
         fd, name = mkstemp()
         fp = os.fdopen(fd, 'wb')
-        fp.write(self.get_html(*args, **kwargs))
-        fp.close()
-        return name
+        part_filename = None
+        if self.partial_dir and method == 'GET':
+            key = uri.encode('utf-8') if isinstance(uri, unicode) else uri
+            part_filename = os.path.join(self.partial_dir, hashlib.sha1(key).hexdigest())
+
+        def attempt():
+            self.logger.debug('Attempt: %s %s (streaming)', method, uri)
+            # Start over if an earlier attempt wrote part of the body.
+            fp.seek(0)
+            fp.truncate()
+            rate_limit.get_limiter().wait(uri, self.rate_limit, self.rate_burst, self.logger)
+            try:
+                with self.timed('http'):
+                    if part_filename:
+                        result = streaming.resumable_download(uri, fp, part_filename, headers,
+                            self.h.timeout, self.h.disable_ssl_certificate_validation,
+                            follow_redirects, self.download_parts, self.download_part_size)
+                    else:
+                        result = streaming.download(uri, fp, method, body, headers, self.h.timeout,
+                            self.h.disable_ssl_certificate_validation, follow_redirects)
+            except socket.gaierror:
+                raise RetrievalError("Could not %s %r: server not found" % (method, uri))
+            self.increment('num_requests')
+            self.increment('bytes_downloaded', result.bytes_received)
+            self.increment('bytes_decoded', result.bytes_decoded)
+            self.logger.debug('Downloaded %s bytes, %s decoded', result.bytes_received, result.bytes_decoded)
+            return result.resp_headers, result
+        try:
+            try:
+                resp_headers, result = retries.call_with_retries(attempt, uri, method,
+                    self.retry_policy, self.circuit_breaker, self.logger, RetrievalError,
+                    self.get_source())
+            finally:
+                fp.close()
+            self.check_status(method, uri, resp_headers['status'], raise_on_error)
+        except:
+            os.unlink(name)
+            raise
+        self.set_cookies(resp_headers)
+        if method == 'GET':
+            mirror.save(uri, resp_headers, filename=name)
+        return name, resp_headers
 
     def get_html(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
         return self.get_html_and_headers(uri, data, headers, send_cookies, follow_redirects, raise_on_error, basic_auth)[0]
 
-    def get_html_and_headers(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
-        if self.sleep and self.page_downloaded:
-            self.logger.debug('Sleeping for %s seconds', self.sleep)
-            time.sleep(self.sleep)
-        self.page_downloaded = True
-
-        # Prepare the request.
+    def prepare_request(self, data=None, headers=None, send_cookies=True, basic_auth=None):
+        """
+        Returns a tuple of (method, body, headers) for a request with the
+        given POST data, adding the user agent, basic auth and cookie headers.
+        """
         if not headers:
             headers = {}
         headers['user-agent'] = headers.get('user-agent', self.user_agent)
@@ -392,45 +1117,68 @@ class Scraper(object):
         body = urlencode(data) if isinstance(data, dict) else data
         if method == "POST" and body and 'Content-Type' not in headers:
             headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return method, body, headers
 
-        # Get the response.
-        resp_headers = None
-        for attempt_number in range(3):
-            self.logger.debug('Attempt %s: %s %s', attempt_number + 1, method, uri)
+    def check_status(self, method, uri, status, raise_on_error=True):
+        "Raises RetrievalError if raise_on_error is set and the status is an error."
+        if raise_on_error and (status in ('400', '408') or status in self.retry_policy.retry_statuses):
+            raise RetrievalError("Could not %s %r: HTTP status %s" % (method, uri, status))
+        if raise_on_error and status == '404':
+            raise PageNotFoundError("Could not %s %r: HTTP status %s" % (method, uri, status))
+
+    def set_cookies(self, resp_headers):
+        "Keeps any cookies set by the given response."
+        if 'set-cookie' in resp_headers:
+            try:
+                self._cookies.load(resp_headers['set-cookie'])
+            except CookieError:
+                # Skip invalid cookies.
+                pass
+
+    def get_html_and_headers(self, uri, data=None, headers=None, send_cookies=True, follow_redirects=True, raise_on_error=True, basic_auth=None):
+        method, body, headers = self.prepare_request(data, headers, send_cookies, basic_auth)
+        entry = self.get_mirrored(uri) if method == 'GET' else None
+        if entry is not None:
+            with open(entry.filename, 'rb') as fp:
+                return fp.read(), entry.resp_headers()
+
+        # Get the response, retrying according to retry_policy.
+        def attempt():
+            self.logger.debug('Attempt: %s %s', method, uri)
             if data:
                 self.logger.debug('Data: %r', data)
             if headers:
                 self.logger.debug('Headers: %r' % headers)
+            rate_limit.get_limiter().wait(uri, self.rate_limit, self.rate_burst, self.logger)
             try:
-                resp_headers, content = self.h.request(uri, method, body=body, headers=headers)
-                if resp_headers['status'] == '500':
-                    self.logger.debug("Request got a 500 error: %s %s", method, uri)
-                    continue # Try again.
-                break
-            except socket.timeout:
-                self.logger.debug("Request timed out after %s seconds: %s %s", self.h.timeout, method, uri)
-                continue # Try again.
-            except socket.error, e:
-                self.logger.debug("Got socket error: %s", e)
-                continue # Try again.
+                with self.timed('http'):
+                    resp_headers, content = self.h.request(uri, method, body=body, headers=headers)
             except httplib2.ServerNotFoundError:
                 raise RetrievalError("Could not %s %r: server not found" % (method, uri))
-        if resp_headers is None:
-            raise RetrievalError("Request timed out 3 times: %s %s" % (method, uri))
-
-        # Raise RetrievalError if necessary.
-        if raise_on_error and resp_headers['status'] in ('400', '408', '500'):
-            raise RetrievalError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
-        if raise_on_error and resp_headers['status'] == '404':
-            raise PageNotFoundError("Could not %s %r: HTTP status %s" % (method, uri, resp_headers['status']))
+            self.increment('num_requests')
+            # httplib2 has already decompressed the content, so the size on
+            # the wire isn't known.
+            self.increment('bytes_downloaded', len(content))
+            self.increment('bytes_decoded', len(content))
+            return resp_headers, content
+        def fetch():
+            return retries.call_with_retries(attempt, uri, method,
+                self.retry_policy, self.circuit_breaker, self.logger, RetrievalError,
+                self.get_source())
+        if method == 'GET' and self.coalesce_ttl is not None:
+            (resp_headers, content), shared = single_flight.coalesce(fetch, method, uri, headers,
+                self.coalesce_ttl, lambda result: result[0]['status'], self.get_source())
+            if shared:
+                self.logger.debug('Shared the response to an identical request for %s', uri)
+                self.increment('num_coalesced')
+                resp_headers = copy.copy(resp_headers)
+        else:
+            resp_headers, content = fetch()
 
-        # Set any received cookies.
-        if 'set-cookie' in resp_headers:
-            try:
-                self._cookies.load(resp_headers['set-cookie'])
-            except CookieError:
-                # Skip invalid cookies.
-                pass
+        self.check_status(method, uri, resp_headers['status'], raise_on_error)
+        self.set_cookies(resp_headers)
+        if method == 'GET':
+            mirror.save(uri, resp_headers, content)
 
         # Handle redirects that weren't caught by httplib2 for whatever reason.
         if follow_redirects and resp_headers['status'] in ('301', '302', '303'):
@@ -454,13 +1202,85 @@ class Scraper(object):
         return content, resp_headers
 
 
+    def get_mirrored(self, uri):
+        """
+        Returns the mirror.MirrorEntry for a GET of the given URI if mirror
+        mode is on and the mirror has a copy, or None. If the mirror is
+        offline, raises RetrievalError if it doesn't have a copy.
+        """
+        store = mirror.get_store()
+        if store is None:
+            return None
+        entry = mirror.lookup(uri)
+        if entry is None:
+            if mirror.is_offline():
+                raise RetrievalError("Could not GET %r: not in the mirror at %s" % (uri, store.directory))
+            return None
+        self.logger.debug('Reading %s from the mirror', uri)
+        self.increment('num_mirrored')
+        access_log.record('GET', uri, 200, 0, os.path.getsize(entry.filename), cache='hit',
+            source=self.get_source())
+        return entry
+
     def ftp_get(self, parse_result):
-        ftp = ftplib.FTP(parse_result.netloc)
-        ftp.login()
-        sio = StringIO()
-        ftp.retrbinary('RETR {0}'.format(parse_result.path), sio.write)
-        ftp.quit()
-        return sio.getvalue()
+        "Returns the contents of the file at the given parsed ftp:// URI."
+        filename = self.ftp_download(parse_result.geturl())[0]
+        try:
+            with open(filename, 'rb') as fp:
+                return fp.read()
+        finally:
+            os.unlink(filename)
+
+    def ftp_download(self, uri, headers=None, raise_on_error=True):
+        """
+        Downloads the file at the given ftp:// URI to a temporary file with a
+        pooled connection, and returns a tuple of (filename, header
+        dictionary), like download(). The headers hold the status ('200',
+        or '404' if the server refused the file), content-length and
+        last-modified. An If-Modified-Since header is honored with a '304'
+        status, so ftp:// URIs work with conditional_get_to_file(). Like
+        GET requests, transfers are resumable; see partial_dir.
+        """
+        from tempfile import mkstemp
+        import hashlib
+        if_modified_since = dict((k.lower(), v) for k, v in (headers or {}).items()).get('if-modified-since')
+        fd, name = mkstemp()
+        fp = os.fdopen(fd, 'wb')
+        part_filename = None
+        if self.partial_dir:
+            key = uri.encode('utf-8') if isinstance(uri, unicode) else uri
+            part_filename = os.path.join(self.partial_dir, hashlib.sha1(key).hexdigest())
+
+        def attempt():
+            self.logger.debug('Attempt: RETR %s', uri)
+            fp.seek(0)
+            fp.truncate()
+            rate_limit.get_limiter().wait(uri, self.rate_limit, self.rate_burst, self.logger)
+            try:
+                with self.timed('http'):
+                    result = ftp_pool.download(uri, fp, part_filename, if_modified_since,
+                        self.h.timeout, self.ftp_passive)
+            except socket.gaierror:
+                raise RetrievalError("Could not RETR %r: server not found" % uri)
+            except ftplib.error_perm, e:
+                # Most likely a failed login.
+                raise RetrievalError("Could not RETR %r: %s" % (uri, e))
+            self.increment('num_requests')
+            self.increment('bytes_downloaded', result.bytes_received)
+            self.increment('bytes_decoded', result.bytes_decoded)
+            return result.resp_headers, result
+        try:
+            try:
+                resp_headers, result = retries.call_with_retries(attempt, uri, 'RETR',
+                    self.retry_policy, self.circuit_breaker, self.logger, RetrievalError,
+                    self.get_source())
+            finally:
+                fp.close()
+            self.check_status('RETR', uri, resp_headers['status'], raise_on_error)
+        except:
+            os.unlink(name)
+            raise
+        return name, resp_headers
 
     def save_tempfile(self, data):
         """
@@ -596,21 +1416,31 @@ class Scraper(object):
         """
         Tries to geocode the given location string
 	"""
+        self.increment('num_geocode_attempted')
         try:
-            return self._geocoder.geocode(location_name)
+            with self.timed('geocode'):
+                result = self._geocoder.geocode(location_name)
         except (GeocodingException, ParsingError):
             return None
+        if result:
+            self.increment('num_geocode_succeeded')
+        return result
 
     def geocode_and_log(self, location_name):
         #Same as geocode() method, but keeps track of addresses that fail to
         #geocode.
+        self.increment('num_geocode_attempted')
         try:
-            return self._geocoder.geocode(location_name)
+            with self.timed('geocode'):
+                result = self._geocoder.geocode(location_name)
         except (GeocodingException, ParsingError) as ex:
             # The ungeocoded_addresses attribute only exists if dry_run() is
             # invoked.
             self.ungeocoded_addresses[location_name] = ex
             return None
+        if result:
+            self.increment('num_geocode_succeeded')
+        return result
 
     def point(self, longitude, latitude, *args, **kwargs):
         return Point(longitude, latitude, *args, **kwargs)
@@ -0,0 +1,90 @@
+"""
+High-water marks for incremental fetching.
+A watermark is the latest item_date (or other timestamp) a scraper has seen
+for a given metro and schema. Scrapers use it to ask their source only for
+records newer than the last run, minus a little overlap, instead of
+re-downloading a fixed look-back window every time.
+"""
+
+import datetime
+import sqlite3
+import threading
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def normalize(value):
+    """
+    Returns the given date or datetime in a form that can be compared with
+    other watermarks. Timezone-aware datetimes are converted to naive UTC.
+    """
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+def encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value.strftime(DATE_FORMAT)
+
+def decode(text):
+    if 'T' in text:
+        return datetime.datetime.strptime(text, DATETIME_FORMAT)
+    return datetime.datetime.strptime(text, DATE_FORMAT).date()
+
+def is_later(a, b):
+    """
+    Returns True if a is later than b. Either may be a date or a datetime; a
+    date counts as the start of that day.
+    """
+    return as_datetime(a) > as_datetime(b)
+
+def as_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime(value.year, value.month, value.day)
+
+
+class WatermarkStore(object):
+    """
+    Maps (metro, schema) to a watermark, stored in a sqlite database.
+    Watermarks only ever move forward.
+    """
+    def __init__(self, file_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS watermarks '
+            '(metro text, schema text, value text, PRIMARY KEY (metro, schema));')
+        self.conn.commit()
+
+    def get(self, metro, schema):
+        "Returns the watermark for the given metro and schema, or None."
+        with self.lock:
+            return self._get(metro, schema)
+
+    def set(self, metro, schema, value):
+        """
+        Sets the watermark for the given metro and schema, unless it's already
+        later than `value`. Returns the resulting watermark.
+        """
+        value = normalize(value)
+        with self.lock:
+            old_value = self._get(metro, schema)
+            if old_value is not None and not is_later(value, old_value):
+                return old_value
+            self.conn.execute('INSERT OR REPLACE INTO watermarks (metro, schema, value) VALUES (?, ?, ?);',
+                (metro, schema, encode(value)))
+            self.conn.commit()
+        return value
+
+    def _get(self, metro, schema):
+        row = self.conn.execute('SELECT value FROM watermarks WHERE metro = ? AND schema = ?;',
+            (metro, schema)).fetchone()
+        if row is None:
+            return None
+        return decode(row[0])
+
+    def close(self):
+        self.conn.close()
+
@@ -0,0 +1,272 @@
+"""
+Pooled, streaming FTP downloads.
+Scraper.ftp_get() used to open a connection for every file, log in, read the
+whole file into memory and quit. FtpPool keeps logged-in connections open
+for each host and server account and lends them out one download at a time,
+with a cap on how many each host gets, since FTP servers often limit logins
+per address. download() writes the file to disk a block at a time, and if
+it's given a partial file, a transfer that's cut off resumes with REST
+instead of starting over, as long as the file's size and modification time
+on the server haven't changed.
+Pool sizes can be set once per process, before any downloads are made:
+    ftp_pool.configure(max_per_host=1, per_host={'ftp.example.gov': 3})
+"""
+
+from collections import defaultdict
+import calendar
+import contextlib
+import email.utils
+import ftplib
+import os
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+import streaming
+from http_pool import get_host
+
+DEFAULT_MAX_PER_HOST = 2
+CHUNK_SIZE = 1024 * 1024
+
+
+class TransientFtpError(socket.error):
+    """
+    A 4xx reply or a connection the server closed. It's a socket.error so
+    that retries.call_with_retries() retries it like any dropped connection.
+    """
+    pass
+
+
+def parse_uri(uri):
+    """
+    Returns a tuple of (host, port, user, password, path) for an ftp:// URI.
+    Servers that aren't given a user are logged in to anonymously.
+    """
+    parts = urlparse.urlsplit(uri)
+    user = urllib.unquote(parts.username) if parts.username else 'anonymous'
+    password = urllib.unquote(parts.password) if parts.password else ''
+    if not password and user == 'anonymous':
+        password = 'anonymous@'
+    path = urllib.unquote(parts.path.split(';')[0]) or '/'
+    return parts.hostname, parts.port or ftplib.FTP_PORT, user, password, path
+
+def quit_quietly(ftp):
+    try:
+        ftp.quit()
+    except (ftplib.all_errors + (EOFError,)):
+        ftp.close()
+
+
+class FtpPool(object):
+    """
+    Lends out logged-in ftplib.FTP objects, with at most `max_per_host` (or
+    per_host[host]) downloads from a host at a time. Connections that have
+    sat idle for longer than `idle_timeout` seconds are closed rather than
+    reused, since servers drop them, and the rest are checked with NOOP.
+    """
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, per_host=None, idle_timeout=60):
+        self.max_per_host = max_per_host
+        self.per_host = dict(per_host or {})
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list) # Maps (host, port, user, passive) to (FTP, time) tuples.
+        self.slots = {} # Maps host to a semaphore with one slot per connection.
+
+    def pool_size(self, host):
+        return self.per_host.get(host, self.max_per_host)
+
+    def get_slots(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.pool_size(host))
+            return self.slots[host]
+
+    def take_idle(self, key):
+        "Returns a live idle connection for the given key, or None."
+        while True:
+            with self.lock:
+                if not self.idle[key]:
+                    return None
+                ftp, last_used = self.idle[key].pop()
+            if time.time() - last_used > self.idle_timeout:
+                quit_quietly(ftp)
+                continue
+            try:
+                ftp.voidcmd('NOOP')
+            except (ftplib.all_errors + (EOFError,)):
+                ftp.close()
+                continue
+            return ftp
+
+    @contextlib.contextmanager
+    def connection(self, uri, timeout=60, passive=True):
+        """
+        Context manager that lends out a logged-in ftplib.FTP for the server
+        in the given URI, in binary mode. If the block raises an exception,
+        the connection is closed rather than reused, in case it's in a bad
+        state.
+        """
+        host, port, user, password, path = parse_uri(uri)
+        key = (host, port, user, passive)
+        slots = self.get_slots(get_host(uri))
+        slots.acquire()
+        try:
+            ftp = self.take_idle(key)
+            if ftp is None:
+                ftp = ftplib.FTP()
+                ftp.connect(host, port, timeout)
+                ftp.login(user, password)
+                ftp.set_pasv(passive)
+                ftp.voidcmd('TYPE I')
+            try:
+                yield ftp
+            except:
+                ftp.close()
+                raise
+            with self.lock:
+                self.idle[key].append((ftp, time.time()))
+        finally:
+            slots.release()
+
+    def close(self):
+        "Logs out of every idle connection."
+        with self.lock:
+            connections = [ftp for idle in self.idle.values() for ftp, last_used in idle]
+            self.idle.clear()
+        for ftp in connections:
+            quit_quietly(ftp)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the process-wide FtpPool. A forked child process gets a pool of
+    its own rather than sharing its parent's connections.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = FtpPool()
+            _pool_pid = os.getpid()
+        return _pool
+
+def configure(max_per_host=DEFAULT_MAX_PER_HOST, per_host=None, idle_timeout=60):
+    "Replaces the process-wide FtpPool with one of the given sizes."
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = FtpPool(max_per_host, per_host, idle_timeout)
+        _pool_pid = os.getpid()
+        return _pool
+
+
+def get_size(ftp, path):
+    "Returns the size of the file at `path`, or None if the server won't say."
+    try:
+        return ftp.size(path)
+    except ftplib.error_perm:
+        return None
+
+def get_last_modified(ftp, path):
+    """
+    Returns the modification time of the file at `path` as an HTTP date, or
+    None if the server doesn't support MDTM.
+    """
+    try:
+        reply = ftp.sendcmd('MDTM ' + path)
+    except ftplib.error_perm:
+        return None
+    try:
+        timestamp = time.strptime(reply.split()[1][:14], '%Y%m%d%H%M%S')
+    except (IndexError, ValueError):
+        return None
+    return email.utils.formatdate(calendar.timegm(timestamp), usegmt=True)
+
+def is_modified_since(last_modified, if_modified_since):
+    "Returns False if the HTTP date `last_modified` is no later than `if_modified_since`."
+    if not (last_modified and if_modified_since):
+        return True
+    modified = email.utils.parsedate_tz(last_modified)
+    since = email.utils.parsedate_tz(if_modified_since)
+    if modified is None or since is None:
+        return True
+    return email.utils.mktime_tz(modified) > email.utils.mktime_tz(since)
+
+def retrieve(ftp, path, fp, rest=None, chunk_size=CHUNK_SIZE):
+    """
+    Writes the file at `path` to the file object `fp`, starting `rest`
+    bytes in, and returns the number of bytes written. 4xx replies and
+    connections closed mid-transfer are raised as TransientFtpError.
+    """
+    received = [0]
+    def write(block):
+        fp.write(block)
+        received[0] += len(block)
+    try:
+        ftp.retrbinary('RETR ' + path, write, chunk_size, rest)
+    except (ftplib.error_temp, ftplib.error_reply, EOFError), e:
+        raise TransientFtpError('Transfer of %s stopped after %s bytes: %s' % (path, received[0], e))
+    return received[0]
+
+def download(uri, fp, part_filename=None, if_modified_since=None, timeout=60, passive=True,
+        pool=None, chunk_size=CHUNK_SIZE):
+    """
+    Downloads the file at the given ftp:// URI into the file object `fp`
+    with a pooled connection, and returns a streaming.Download whose headers
+    stand in for HTTP's: status '200', with content-length and last-modified
+    from SIZE and MDTM if the server supports them, '304' (and nothing
+    downloaded) if the file hasn't been modified since `if_modified_since`,
+    or '404' if the server refuses the file. If `part_filename` is given,
+    the file is kept there until all of it has arrived, so that if the
+    transfer is cut off and TransientFtpError or a socket.error is raised,
+    calling this again resumes it.
+    """
+    pool = pool or get_pool()
+    path = parse_uri(uri)[4]
+    with pool.connection(uri, timeout, passive) as ftp:
+        size = get_size(ftp, path)
+        last_modified = get_last_modified(ftp, path)
+        resp_headers = {'status': '200'}
+        if size is not None:
+            resp_headers['content-length'] = str(size)
+        if last_modified:
+            resp_headers['last-modified'] = last_modified
+        if not is_modified_since(last_modified, if_modified_since):
+            return streaming.Download(uri, dict(resp_headers, status='304'), 0, 0)
+        try:
+            if part_filename is None:
+                received = retrieve(ftp, path, fp, chunk_size=chunk_size)
+                total = received
+            else:
+                part = streaming.PartialFile(part_filename)
+                # Only resume a file that's the same size and age as the one
+                # the partial file was started from.
+                if part.size and (last_modified is None or size is None or
+                        part.meta.get('last_modified') != last_modified or
+                        part.meta.get('length') != size):
+                    part.delete()
+                rest = part.size or None
+                if not rest:
+                    part.start(resp_headers, size)
+                with open(part.filename, 'ab') as part_fp:
+                    received = retrieve(ftp, path, part_fp, rest, chunk_size)
+                total = part.size
+        except ftplib.error_perm, e:
+            if part_filename is not None and rest:
+                # The server won't resume, so start over next time.
+                part.delete()
+                raise TransientFtpError('Could not resume %s: %s' % (uri, e))
+            resp_headers['status'] = '404'
+            return streaming.Download(uri, resp_headers, 0, 0)
+    if size is not None and total < size:
+        raise streaming.IncompleteDownload('Got %s of %s bytes from %s' % (total, size, uri))
+    if part_filename is not None:
+        streaming.decode_files([part.filename], fp, None, chunk_size)
+        part.delete()
+    return streaming.Download(uri, resp_headers, received, total)
@@ -0,0 +1,191 @@
+"""
+Retry policy and per-host circuit breaker for HTTP requests.
+call_with_retries() makes a request until it gets a response that's worth
+keeping, waiting between attempts with exponential backoff and jitter (or
+for as long as the server's Retry-After header asks). A CircuitBreaker
+shared by the whole process stops requests to a host that keeps failing,
+instead of having every scraper hammer it in turn.
+"""
+
+import email.utils
+import logging
+import random
+import socket
+import threading
+import time
+
+from http_pool import get_host
+import access_log
+
+
+class RetryPolicy(object):
+    """
+    Decides which failures are retried and how long to wait before each
+    retry. The wait before retry n is a random time up to
+    min(max_delay, base_delay * 2 ** (n - 1)) seconds ("full jitter"), unless
+    the server sent Retry-After. No request takes longer than `deadline`
+    seconds in total, including waits.
+    """
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=60.0, jitter=True,
+            deadline=300, retry_statuses=('429', '500', '502', '503', '504'),
+            retry_after_statuses=('429', '503')):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.retry_after_statuses = retry_after_statuses
+
+    def get_wait(self, attempt_number, retry_after=None):
+        "Returns the number of seconds to wait before the given retry."
+        if retry_after is not None:
+            return retry_after
+        wait = min(self.max_delay, self.base_delay * 2 ** (attempt_number - 1))
+        if self.jitter:
+            wait = random.uniform(0, wait)
+        return wait
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failed attempts for each host. After
+    `failure_threshold` of them, the circuit for that host opens and
+    allow() returns False for `reset_timeout` seconds. After that a single
+    trial request is let through: if it succeeds the circuit closes, and if
+    it fails the circuit opens again.
+    """
+    def __init__(self, failure_threshold=10, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened_at = {}
+
+    def allow(self, host):
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return True
+            if time.time() - opened_at >= self.reset_timeout:
+                # Let one trial request through. Until it finishes, everyone
+                # else sees the circuit as open.
+                self.opened_at[host] = time.time()
+                return True
+            return False
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                self.opened_at[host] = time.time()
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds a Retry-After header value asks for, or
+    None if it can't be parsed. The value is either a number of seconds or an
+    HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+def log_retry(logger, **fields):
+    """
+    Logs a retry as key=value pairs. The fields are also attached to the log
+    record as `retry`, for handlers that want them as data.
+    """
+    message = ' '.join('%s=%s' % (key, fields[key]) for key in sorted(fields))
+    logger.warning('retry %s', message, extra={'retry': fields})
+
+def call_with_retries(attempt, uri, method='GET', policy=None, breaker=None,
+        logger=None, error_class=Exception, source=None):
+    """
+    Calls attempt(), which makes one request and returns a tuple of
+    (response headers, content) from httplib2, until it returns a status
+    that isn't in policy.retry_statuses or the policy gives up. Timeouts and
+    socket errors are retried too. Returns the last (headers, content).
+    Raises error_class if the host's circuit is open or no attempt got a
+    response at all. The request is recorded in the access log as made by
+    `source`.
+    """
+    start = time.time()
+    progress = {'attempts': 0}
+    try:
+        resp_headers, content = _call_with_retries(attempt, uri, method, policy,
+            breaker, logger, error_class, progress)
+    except Exception, e:
+        access_log.record(method, uri, elapsed=time.time() - start,
+            retries=max(0, progress['attempts'] - 1), source=source, error=str(e))
+        raise
+    status = resp_headers['status']
+    access_log.record(method, uri, status, time.time() - start, get_size(content),
+        progress['attempts'] - 1, 'hit' if status == '304' else None, source)
+    return resp_headers, content
+
+def get_size(content):
+    "Returns the number of bytes received for the content of a response."
+    if isinstance(content, basestring):
+        return len(content)
+    return getattr(content, 'bytes_received', None)
+
+def _call_with_retries(attempt, uri, method, policy, breaker, logger, error_class, progress):
+    policy = policy or RetryPolicy()
+    breaker = breaker or circuit_breaker
+    logger = logger or logging.getLogger('eb.retrieval.retries')
+    host = get_host(uri)
+    start = time.time()
+    resp_headers = content = None
+    attempt_number = 0
+    while True:
+        if not breaker.allow(host):
+            raise error_class("Not trying %s %r: too many recent failures from %s" % (method, uri, host))
+        attempt_number += 1
+        progress['attempts'] = attempt_number
+        error = status = None
+        try:
+            resp_headers, content = attempt()
+            status = resp_headers['status']
+        except socket.timeout:
+            error = 'timeout'
+        except socket.error, e:
+            error = 'socket error: %s' % e
+        if error is None and status not in policy.retry_statuses:
+            breaker.record_success(host)
+            break
+        breaker.record_failure(host)
+
+        retry_after = None
+        if status in policy.retry_after_statuses:
+            retry_after = parse_retry_after(resp_headers.get('retry-after'))
+        wait = policy.get_wait(attempt_number, retry_after)
+        elapsed = time.time() - start
+        if attempt_number >= policy.max_attempts:
+            break
+        if policy.deadline and elapsed + wait > policy.deadline:
+            logger.warning('Giving up on %s %s: waiting %.1fs would pass the %ss deadline',
+                method, uri, wait, policy.deadline)
+            break
+        log_retry(logger, method=method, uri=uri, host=host, attempt=attempt_number,
+            status=status, error=error, wait='%.2f' % wait, retry_after=retry_after,
+            elapsed='%.2f' % elapsed)
+        time.sleep(wait)
+
+    if resp_headers is None:
+        raise error_class("Request failed %s times: %s %s" % (attempt_number, method, uri))
+    return resp_headers, content
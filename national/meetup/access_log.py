@@ -0,0 +1,110 @@
+"""
+Per-request access log.
+Every HTTP request made by a Scraper, Retriever or Pipeline is recorded with
+its method, URI, status, elapsed time, size, number of retries and whether
+it was answered from a cache, along with the scraper that made it. Records
+are written as JSON lines or as tab-separated text in LOG_ENTRY_FMT, to a
+file that can be rotated. Nothing is written until the log is configured,
+either by calling configure() or by setting the EB_ACCESS_LOG environment
+variable to a file path (which run_scrapers.py --access-log does):
+    EB_ACCESS_LOG=access.jsonl python boston_crime_scrape.py
+access_log_summary.py in the repository root reports on the result.
+"""
+
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import threading
+
+from http_pool import get_host
+
+# Tab-separated fields of a text log entry. The first six are the ones
+# retrieval.py has always defined.
+LOG_ENTRY_FMT = "%(timestamp)s\t%(method)s\t%(uri)s\t%(status)s\t%(elapsed)s\t%(size)s"
+TEXT_ENTRY_FMT = LOG_ENTRY_FMT + "\t%(retries)s\t%(cache)s\t%(source)s\t%(error)s"
+
+FIELDS = ('timestamp', 'method', 'uri', 'host', 'status', 'elapsed', 'size',
+    'retries', 'cache', 'source', 'error')
+
+logger = logging.getLogger('eb.access')
+logger.propagate = False
+
+_configured = False
+_lock = threading.Lock()
+
+
+class EntryFormatter(logging.Formatter):
+    "Formats the entry attached to a log record as JSON or as text."
+    def __init__(self, format='json'):
+        logging.Formatter.__init__(self)
+        self.format_name = format
+
+    def format(self, record):
+        entry = record.entry
+        if self.format_name == 'json':
+            return json.dumps(entry, sort_keys=True)
+        return TEXT_ENTRY_FMT % dict((k, clean(v)) for k, v in entry.items())
+
+
+def clean(value):
+    "Makes a value safe to put in a tab-separated line."
+    if value is None:
+        return ''
+    return unicode(value).replace('\t', ' ').replace('\n', ' ')
+
+
+def configure(path, format='json', max_bytes=0, backup_count=5):
+    """
+    Starts writing entries to the file at `path`, in 'json' or 'text'
+    format. If `max_bytes` is set, the file is rotated when it reaches that
+    size, keeping `backup_count` old files. Rotation isn't safe when several
+    processes share a file, so it's off by default.
+    """
+    global _configured
+    with _lock:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(EntryFormatter(format))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        _configured = True
+
+def is_enabled():
+    "Returns True if entries are being written, configuring from the environment if needed."
+    global _configured
+    if not _configured:
+        path = os.environ.get('EB_ACCESS_LOG')
+        if path:
+            configure(path, os.environ.get('EB_ACCESS_LOG_FORMAT', 'json'),
+                int(os.environ.get('EB_ACCESS_LOG_MAX_BYTES', 0)))
+        else:
+            _configured = True
+    return bool(logger.handlers)
+
+def record(method, uri, status=None, elapsed=None, size=None, retries=0, cache=None,
+        source=None, error=None):
+    """
+    Writes an entry for one request. `status` is None if no response was
+    received, in which case `error` says why. `cache` is 'hit' for responses
+    that came from a cache (including 304 Not Modified) and None otherwise.
+    """
+    if not is_enabled():
+        return
+    entry = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'method': method,
+        'uri': uri,
+        'host': get_host(uri),
+        'status': int(status) if status else None,
+        'elapsed': round(elapsed, 4) if elapsed is not None else None,
+        'size': size,
+        'retries': retries,
+        'cache': cache,
+        'source': source,
+        'error': error,
+    }
+    logger.info('%s %s', method, uri, extra={'entry': entry})
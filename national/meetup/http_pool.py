@@ -0,0 +1,169 @@
+"""
+Process-wide pool of keep-alive HTTP connections.
+httplib2.Http keeps its connections open between requests, but every
+Scraper and Retriever used to make its own, so nothing was shared between
+scrapers hitting the same host and each one paid for its own TCP and TLS
+handshakes. HttpPool keeps idle httplib2.Http objects for each host and lends
+them out one request at a time, with a cap on how many connections each host
+gets. It also shares a set of requests connection pools between every
+requests.Session it's asked to mount, for sundew pipelines.
+Typical use is through PooledHttp, which stands in for httplib2.Http:
+    self.h = http_pool.PooledHttp(timeout=20)
+    resp_headers, content = self.h.request(uri, 'GET')
+Pool sizes can be set once per process, before any requests are made:
+    http_pool.configure(max_per_host=8, per_host={'data.seattle.gov': 2})
+"""
+
+from collections import defaultdict
+import contextlib
+import os
+import threading
+import urlparse
+
+import httplib2
+
+DEFAULT_MAX_PER_HOST = 4
+
+
+def get_host(uri):
+    "Returns the lowercased host (and port, if any) of the given URI."
+    return urlparse.urlsplit(uri).netloc.lower()
+
+
+class HttpPool(object):
+    """
+    Lends out httplib2.Http objects, each holding open connections, with at
+    most `max_per_host` (or per_host[host]) requests to a host at a time.
+    Requests beyond that wait for a connection to come back.
+    """
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, per_host=None):
+        self.max_per_host = max_per_host
+        self.per_host = dict(per_host or {})
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list) # Maps (host, options) to idle Http objects.
+        self.slots = {} # Maps host to a semaphore with one slot per connection.
+        self.adapters = None
+
+    def pool_size(self, host):
+        return self.per_host.get(host, self.max_per_host)
+
+    def get_slots(self, host):
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.pool_size(host))
+            return self.slots[host]
+
+    @contextlib.contextmanager
+    def connection(self, uri, timeout=20, disable_ssl_certificate_validation=True):
+        """
+        Context manager that lends out an httplib2.Http for a request to the
+        given URI. If the request raises an exception, the Http is thrown away
+        rather than reused, in case its connection is in a bad state.
+        """
+        host = get_host(uri)
+        key = (host, timeout, disable_ssl_certificate_validation)
+        slots = self.get_slots(host)
+        slots.acquire()
+        try:
+            with self.lock:
+                http = self.idle[key].pop() if self.idle[key] else None
+            if http is None:
+                http = httplib2.Http(timeout=timeout,
+                    disable_ssl_certificate_validation=disable_ssl_certificate_validation)
+            yield http
+            with self.lock:
+                self.idle[key].append(http)
+        finally:
+            slots.release()
+
+    def request(self, uri, method='GET', body=None, headers=None, timeout=20,
+            disable_ssl_certificate_validation=True, **attributes):
+        """
+        Makes a request with a pooled connection and returns (headers,
+        content). Other keyword arguments, such as follow_redirects, are set
+        as attributes of the httplib2.Http before the request.
+        """
+        with self.connection(uri, timeout, disable_ssl_certificate_validation) as http:
+            for name, value in attributes.items():
+                setattr(http, name, value)
+            return http.request(uri, method, body=body, headers=headers)
+
+    def mount(self, session):
+        """
+        Makes the given requests.Session use connection pools shared with
+        every other session mounted on this HttpPool. The session keeps its
+        own cookies. Returns the session.
+        """
+        import requests.adapters
+        with self.lock:
+            if self.adapters is None:
+                default = requests.adapters.HTTPAdapter(pool_maxsize=self.max_per_host)
+                self.adapters = [('http://', default), ('https://', default)]
+                for host, size in sorted(self.per_host.items()):
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                    self.adapters.append(('http://%s/' % host, adapter))
+                    self.adapters.append(('https://%s/' % host, adapter))
+        for prefix, adapter in self.adapters:
+            session.mount(prefix, adapter)
+        return session
+
+    def close(self):
+        "Closes every idle connection."
+        with self.lock:
+            for https in self.idle.values():
+                for http in https:
+                    for conn in http.connections.values():
+                        conn.close()
+            self.idle.clear()
+            if self.adapters is not None:
+                for prefix, adapter in self.adapters:
+                    adapter.close()
+                self.adapters = None
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns the process-wide HttpPool. A forked child process gets a pool
+    of its own rather than sharing its parent's sockets.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = HttpPool()
+            _pool_pid = os.getpid()
+        return _pool
+
+def configure(max_per_host=DEFAULT_MAX_PER_HOST, per_host=None):
+    "Replaces the process-wide HttpPool with one of the given sizes."
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = HttpPool(max_per_host, per_host)
+        _pool_pid = os.getpid()
+        return _pool
+
+
+class PooledHttp(object):
+    """
+    Stands in for httplib2.Http, but borrows a connection from the
+    process-wide pool for each request. Like httplib2.Http, it has timeout,
+    follow_redirects and force_exception_to_status_code attributes.
+    """
+    def __init__(self, timeout=20, disable_ssl_certificate_validation=True, pool=None):
+        self.timeout = timeout
+        self.disable_ssl_certificate_validation = disable_ssl_certificate_validation
+        self.follow_redirects = True
+        self.force_exception_to_status_code = False
+        self.pool = pool
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        pool = self.pool or get_pool()
+        return pool.request(uri, method, body, headers, self.timeout,
+            self.disable_ssl_certificate_validation,
+            follow_redirects=self.follow_redirects,
+            force_exception_to_status_code=self.force_exception_to_status_code)
@@ -9,7 +9,7 @@ class CrimeScraper(Scraper):
     primary_key = ('dc_key',)
 
     def data(self):
-        cutoff_date = datetime.date.today() - datetime.timedelta(days=30)
+        cutoff_date = self.since_watermark(30)
 
         for incident in self.get_crime_incidents(cutoff_date):
             # Rape incidents do not have a real value for dc_key, so we just
@@ -0,0 +1,312 @@
+"""
+Runs every scraper in the repository in a pool of worker processes.
+Scrapers are discovered by reading the source of each module in the metro
+directories, so nothing is imported in the parent process. Each scraper runs
+in its own fresh process with its metro directory as the working directory
+and at the front of sys.path, exactly as if its module had been run as a
+script. That matters because every metro directory has its own copy of
+scraper.py, sundew_pipeline.py and friends.
+Usage:
+    python run_scrapers.py --processes 8 --per-host 2 --report report.json
+With --access-log, every HTTP request the scrapers make is recorded in the
+given file; see access_log_summary.py. With --mirror, scrapers read their
+sources from a local mirror filled by mirror_sources.py, and with --offline
+they never touch the network, so the per-host limit doesn't apply.
+"""
+
+import argparse
+import ast
+import collections
+import datetime
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path as op
+import re
+import sys
+import time
+import traceback
+
+ROOT = op.dirname(op.abspath(__file__))
+
+METRO_DIRS = ('boston', 'chicago', 'denver', 'houston', 'nashville', 'philly',
+    'seattle', 'national')
+
+# Base classes that mark a class as something the runner knows how to run,
+# mapped to the method that runs it.
+BASE_CLASSES = {
+    'Scraper': 'run',
+    'NewsItemListDetailScraper': 'update',
+    'Pipeline': 'get_values',
+}
+
+# Modules that define the base classes themselves rather than scrapers.
+LIBRARY_MODULES = ('scraper', 'sundew_pipeline', 'newsitem_list_detail',
+    'list_detail', 'retrieval', 'retrieval_base', 'stages')
+
+URL_RE = re.compile(r'^https?://([\w.-]+)(?:[/:?]|$)')
+
+ScraperTask = collections.namedtuple('ScraperTask', [
+    'directory',
+    'module',
+    'class_name',
+    'method',
+    'hosts',
+])
+
+logger = logging.getLogger('eb.retrieval.run_scrapers')
+
+
+def base_names(class_node):
+    "Yields the unqualified name of each base of an ast.ClassDef."
+    for base in class_node.bases:
+        if isinstance(base, ast.Name):
+            yield base.id
+        elif isinstance(base, ast.Attribute):
+            yield base.attr
+
+def module_info(path):
+    """
+    Returns a tuple of (classes, hosts, imports) for the module at the given
+    path: the (name, base names) of each top-level class, every host named in
+    a URL string literal, and the names of all imported modules.
+    """
+    with open(path) as fp:
+        tree = ast.parse(fp.read(), path)
+    classes = [(node.name, list(base_names(node))) for node in tree.body if isinstance(node, ast.ClassDef)]
+    hosts = set()
+    imports = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Str):
+            m = URL_RE.match(node.s)
+            if m:
+                hosts.add(m.group(1).lower())
+        elif isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            imports.add(node.module)
+    return classes, hosts, imports
+
+def discover(root=ROOT, metro_dirs=METRO_DIRS):
+    """
+    Returns a list of ScraperTasks for every Scraper, NewsItemListDetailScraper
+    and sundew_pipeline.Pipeline subclass under the given metro directories.
+    Pipelines that are imported by another module in the same directory (or
+    that live in a module that also defines a scraper) are that scraper's data
+    source, so they aren't returned as tasks of their own.
+    """
+    tasks = []
+    for metro_dir in metro_dirs:
+        for dirpath, dirnames, filenames in os.walk(op.join(root, metro_dir)):
+            dirnames.sort()
+            modules = {}
+            for filename in sorted(filenames):
+                name, ext = op.splitext(filename)
+                if ext != '.py' or name in LIBRARY_MODULES:
+                    continue
+                try:
+                    modules[name] = module_info(op.join(dirpath, filename))
+                except SyntaxError:
+                    logger.warning('Could not parse %s', op.join(dirpath, filename))
+
+            imported = set()
+            for classes, hosts, imports in modules.values():
+                imported.update(imports)
+
+            for name in sorted(modules):
+                classes, hosts, imports = modules[name]
+                # Include hosts from sibling modules this one imports, such
+                # as a service_requests_pipeline used by a scraper.
+                hosts = set(hosts)
+                for imported_name in imports:
+                    if imported_name in modules:
+                        hosts.update(modules[imported_name][1])
+                methods = dict((cls, BASE_CLASSES[b]) for cls, bases in classes for b in bases if b in BASE_CLASSES)
+                # Classes that subclass another class in the same module
+                # (e.g. a CustomPipeline) inherit its kind.
+                for cls, bases in classes:
+                    for b in bases:
+                        if cls not in methods and b in methods:
+                            methods[cls] = methods[b]
+                has_scraper = any(m != 'get_values' for m in methods.values())
+                for cls, bases in classes:
+                    method = methods.get(cls)
+                    if method is None:
+                        continue
+                    if method == 'get_values' and (has_scraper or name in imported):
+                        continue
+                    tasks.append(ScraperTask(dirpath, name, cls, method, tuple(sorted(hosts))))
+    return tasks
+
+def run_task(task):
+    """
+    Runs a single ScraperTask and returns a report dictionary. This is called
+    in a worker process.
+    """
+    os.chdir(task.directory)
+    sys.path.insert(0, task.directory)
+    report = {
+        'directory': op.relpath(task.directory, ROOT),
+        'module': task.module,
+        'class_name': task.class_name,
+        'hosts': list(task.hosts),
+        'update_start': datetime.datetime.now(),
+        'got_error': True,
+        'traceback': '',
+    }
+    try:
+        module = importlib.import_module(task.module)
+        instance = getattr(module, task.class_name)()
+        if task.method == 'run':
+            results = instance.run(raise_errors=False)
+            report.update(results._asdict())
+        elif task.method == 'update':
+            instance.update()
+            report.update(
+                schema=getattr(instance, 'schema_slugs', None),
+                num_added=instance.num_added,
+                num_changed=instance.num_changed,
+                num_skipped=instance.num_skipped,
+                got_error=False,
+            )
+        else:
+            count = 0
+            for count, value in enumerate(instance.get_values(), 1):
+                pass
+            report.update(schema=instance.name, num_added=count, got_error=False,
+                stages=instance.get_report()['stages'])
+    except:
+        report['traceback'] = traceback.format_exc()
+    report.setdefault('update_finish', datetime.datetime.now())
+    return report
+
+def run_all(tasks, processes=4, per_host=2):
+    """
+    Runs the given tasks in a process pool and returns a list of report
+    dictionaries, one per task. No more than `processes` tasks run at once,
+    and no more than `per_host` tasks that talk to the same host run at once.
+    """
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    pending = list(tasks)
+    running = []
+    host_counts = collections.defaultdict(int)
+    reports = []
+    try:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= processes:
+                    break
+                if all(host_counts[h] < per_host for h in task.hosts):
+                    pending.remove(task)
+                    for h in task.hosts:
+                        host_counts[h] += 1
+                    logger.info('Starting %s.%s', task.module, task.class_name)
+                    running.append((task, pool.apply_async(run_task, (task,))))
+            time.sleep(0.1)
+            for task, result in list(running):
+                if not result.ready():
+                    continue
+                running.remove((task, result))
+                for h in task.hosts:
+                    host_counts[h] -= 1
+                try:
+                    report = result.get()
+                except Exception:
+                    report = {
+                        'directory': op.relpath(task.directory, ROOT),
+                        'module': task.module,
+                        'class_name': task.class_name,
+                        'got_error': True,
+                        'traceback': traceback.format_exc(),
+                    }
+                logger.info('Finished %s.%s (error: %s)', task.module, task.class_name, report['got_error'])
+                reports.append(report)
+    finally:
+        pool.terminate()
+        pool.join()
+    return reports
+
+def print_report(reports, fp=sys.stdout):
+    row = '{0:<60} {1:>8} {2:>8} {3:>8} {4:>10}  {5}\n'
+    fp.write(row.format('scraper', 'added', 'changed', 'skipped', 'seconds', 'status'))
+    for report in sorted(reports, key=lambda r: (r['directory'], r['module'], r['class_name'])):
+        name = '%s/%s.%s' % (report['directory'], report['module'], report['class_name'])
+        if 'update_start' in report and 'update_finish' in report:
+            seconds = '%.1f' % (report['update_finish'] - report['update_start']).total_seconds()
+        else:
+            seconds = '-'
+        fp.write(row.format(name, report.get('num_added', '-'), report.get('num_changed', '-'),
+            report.get('num_skipped', '-'), seconds, 'ERROR' if report['got_error'] else 'ok'))
+    num_errors = len([r for r in reports if r['got_error']])
+    fp.write('\n%s scrapers run, %s failed.\n' % (len(reports), num_errors))
+
+def json_default(obj):
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    return unicode(obj)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run all scrapers in parallel.')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+        help='number of scrapers to run at once')
+    parser.add_argument('--per-host', type=int, default=2,
+        help='maximum number of scrapers talking to the same host at once')
+    parser.add_argument('--only', action='append', default=[],
+        help='only run scrapers whose "directory/module.Class" name contains this string')
+    parser.add_argument('--exclude', action='append', default=[],
+        help='skip scrapers whose "directory/module.Class" name contains this string')
+    parser.add_argument('--report', help='also write the report to this JSON file')
+    parser.add_argument('--list', action='store_true', help='list scrapers and exit')
+    parser.add_argument('--access-log',
+        help='record every HTTP request in this file (see access_log_summary.py)')
+    parser.add_argument('--access-log-format', choices=('json', 'text'), default='json',
+        help='format of the access log')
+    parser.add_argument('--mirror',
+        help='read sources from the mirror in this directory (see mirror_sources.py)')
+    parser.add_argument('--offline', action='store_true',
+        help='with --mirror, fail instead of downloading sources that are not mirrored')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+
+    tasks = []
+    for task in discover():
+        name = '%s/%s.%s' % (op.relpath(task.directory, ROOT), task.module, task.class_name)
+        if args.only and not any(s in name for s in args.only):
+            continue
+        if any(s in name for s in args.exclude):
+            continue
+        tasks.append(task)
+
+    if args.list:
+        for task in tasks:
+            print '%s/%s.%s %s' % (op.relpath(task.directory, ROOT), task.module, task.class_name, ','.join(task.hosts))
+        return 0
+
+    if args.access_log:
+        # Worker processes configure their access log from the environment.
+        os.environ['EB_ACCESS_LOG'] = op.abspath(args.access_log)
+        os.environ['EB_ACCESS_LOG_FORMAT'] = args.access_log_format
+
+    per_host = args.per_host
+    if args.mirror:
+        # Worker processes configure their mirror from the environment too.
+        os.environ['EB_MIRROR'] = op.abspath(args.mirror)
+        os.environ['EB_MIRROR_MODE'] = 'offline' if args.offline else 'read'
+        if args.offline:
+            per_host = args.processes
+    elif args.offline:
+        parser.error('--offline needs --mirror')
+
+    reports = run_all(tasks, processes=args.processes, per_host=per_host)
+    print_report(reports)
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump(reports, fp, indent=2, default=json_default)
+    return 1 if any(r['got_error'] for r in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
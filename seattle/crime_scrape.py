@@ -79,7 +79,7 @@ class CrimeScraper(Scraper):
             )
 
     def get_incident_reports(self):
-        start_date = self.start_date - datetime.timedelta(days=90)
+        start_date = self.since_watermark(90)
         inline_query = inline_query_template.substitute(
             start_date=start_date.strftime('%Y-%m-%dT00:00:00'))
 
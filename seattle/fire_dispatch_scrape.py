@@ -20,26 +20,38 @@ class SeattleFireDispatchScraper(NewsItemListDetailScraper):
     uri_template = 'http://www2.seattle.gov/fire/realTime911/getRecsForDatePub.asp?%s'
     schema_slugs = ['fire-dispatch']
     has_detail = False
-    sleep = 1
+    rate_limit = 1 # Requests a second.
+    checkpoint = True
     parse_list_re = re.compile(r"(?s)<tr id=row_\d+[^>]*>\s*<td[^>]*>(?P<date>.*?)</td>\s*<td[^>]*>(?P<incident_number>.*?)</td>\s*<td[^>]*>(?P<level>.*?)</td>\s*<td[^>]*>(?P<units>.*?)</td>\s*<td[^>]*>(?P<location>.*?)</td>\s*<td[^>]*>(?P<type>.*?)</td>\s*</tr>")
     record_check = ('incident_number',)
 
     def __init__(self, *args, **kwargs):
         self.get_archive = kwargs.pop('get_archive', False)
         super(SeattleFireDispatchScraper, self).__init__(*args, **kwargs)
-        self.retriever = UnicodeRetriever()
+        self.retriever = UnicodeRetriever(rate_limit=self.rate_limit, rate_burst=self.rate_burst,
+            source=self.get_source())
 
     def list_pages(self):
         if self.get_archive:
             date = datetime.date(2003, 11, 7)
         else:
             date = datetime.date.today() - datetime.timedelta(days=7)
-        while 1:
-            if date == datetime.date.today():
-                break
+        # Pick up after the last day a failed update() finished.
+        if self.resume_cursor() is not None:
+            date = self.resume_cursor() + datetime.timedelta(days=1)
+        urls = []
+        while date < datetime.date.today():
             params = urlencode({'incDate': date.strftime('%m/%d/%y'), 'rad1': 'des'})
-            yield self.get_html(self.uri_template % params)
+            urls.append((self.uri_template % params, date))
             date += datetime.timedelta(days=1)
+        # Fetch several days at once, but yield them in order so that each
+        # checkpoint covers every day before it. rate_limit still starts at
+        # most one request a second, the pace the old one-second sleep set,
+        # so the fan-out only overlaps each page's download with the wait
+        # for the next; the run is still bound by the politeness limit.
+        for (url, date), html in self.fetch_all(urls, lambda request: self.get_html(request[0])):
+            yield html
+            self.save_checkpoint(date)
 
     def clean_list_record(self, record):
         try:
@@ -0,0 +1,121 @@
+"""
+Per-host rate limiting shared by every Scraper, Retriever and Pipeline in
+the process.
+Each host gets a token bucket: it holds up to `burst` tokens, refills at
+`rate` tokens a second, and every request takes one. A request that finds
+the bucket empty waits only for its own host, so requests to different
+hosts, e.g. from fetch_all(), never hold each other up.
+    limiter = rate_limit.get_limiter()
+    limiter.wait('http://data.seattle.gov/...', rate=1)
+Limits for particular hosts can be set once per process, and take priority
+over the rates callers ask for:
+    rate_limit.configure(per_host={'data.seattle.gov': (2, 4)})
+"""
+
+import os
+import threading
+import time
+
+from http_pool import get_host
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests a second on average, with bursts of up to `burst`
+    requests at once. Callers that find the bucket empty borrow against
+    future tokens, so concurrent callers are spaced out rather than all
+    waking up at the same moment.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        "Takes a token and returns the number of seconds to wait before using it."
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def set_rate(self, rate, burst=1):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+
+class RateLimiter(object):
+    """
+    Keeps a TokenBucket for each host. A host's rate comes from `per_host`
+    (a dictionary mapping hosts to (rate, burst) tuples) if it's there, or
+    else from the callers: if two scrapers ask for different rates for the
+    same host, the slower one wins.
+    """
+    def __init__(self, per_host=None):
+        self.per_host = dict(per_host or {})
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def get_bucket(self, host, rate=None, burst=1):
+        "Returns the TokenBucket for the given host, or None if it isn't limited."
+        with self.lock:
+            if host in self.per_host:
+                rate, burst = self.per_host[host]
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                if not rate:
+                    return None
+                bucket = self.buckets[host] = TokenBucket(rate, burst)
+            elif rate and host not in self.per_host and rate < bucket.rate:
+                bucket.set_rate(rate, burst)
+            return bucket
+
+    def wait(self, uri, rate=None, burst=1, logger=None):
+        """
+        Waits until a request to the given URI is allowed. `rate` is the
+        number of requests a second the caller wants for the URI's host, or
+        None for no limit of its own. Returns the number of seconds waited.
+        """
+        host = get_host(uri)
+        bucket = self.get_bucket(host, rate, burst)
+        if bucket is None:
+            return 0
+        seconds = bucket.reserve()
+        if seconds:
+            if logger is not None:
+                logger.debug('Waiting %.2f seconds for %s', seconds, host)
+            time.sleep(seconds)
+        return seconds
+
+
+_limiter = None
+_limiter_pid = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    "Returns the process-wide RateLimiter."
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        if _limiter is None or _limiter_pid != os.getpid():
+            _limiter = RateLimiter()
+            _limiter_pid = os.getpid()
+        return _limiter
+
+def configure(per_host=None):
+    "Replaces the process-wide RateLimiter with one with the given host limits."
+    global _limiter, _limiter_pid
+    with _limiter_lock:
+        _limiter = RateLimiter(per_host)
+        _limiter_pid = os.getpid()
+        return _limiter
+
+def rate_from_sleep(sleep):
+    "Converts a number of seconds to sleep between requests to a rate."
+    return 1.0 / sleep if sleep else None
@@ -0,0 +1,468 @@
+"""
+Streaming downloads straight to disk.
+httplib2 reads the whole body of a response into memory before returning
+it, so downloading a multi-hundred-megabyte CSV used to take as much memory
+as the file itself. download() makes the request with httplib instead and
+writes the body to a file a chunk at a time as it arrives. It asks for gzip
+or deflate compression, decompresses on the fly and counts both the bytes
+received and the bytes written.
+resumable_download() keeps the raw body on disk until it's complete, so a
+download that's cut off can be resumed with a Range request instead of
+starting over, and can fetch a large file as several ranges at once.
+"""
+
+import httplib
+import json
+import os
+import re
+import socket
+import ssl
+import sys
+import urlparse
+import zlib
+
+import fetcher
+
+CHUNK_SIZE = 1024 * 1024
+ACCEPT_ENCODING = 'gzip, deflate'
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class Decoder(object):
+    """
+    Decompresses a response body with the given Content-Encoding a chunk at
+    a time. Unknown encodings are passed through as is.
+    """
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').strip().lower()
+        self.started = False
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+
+    def decode(self, data):
+        if self.decompressor is None:
+            return data
+        try:
+            result = self.decompressor.decompress(data)
+        except zlib.error:
+            # Some servers send "deflate" without the zlib header.
+            if self.encoding != 'deflate' or self.started:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self.decompressor.decompress(data)
+        self.started = True
+        return result
+
+    def flush(self):
+        if self.decompressor is None:
+            return ''
+        return self.decompressor.flush()
+
+
+class Download(object):
+    "The outcome of download(): the final URI, its response headers and byte counts."
+    def __init__(self, uri, resp_headers, bytes_received, bytes_decoded):
+        self.uri = uri
+        self.resp_headers = resp_headers
+        self.bytes_received = bytes_received
+        self.bytes_decoded = bytes_decoded
+
+
+def open_connection(uri, timeout=20, disable_ssl_certificate_validation=True):
+    "Returns an httplib connection for the given URI and the path to request."
+    parts = urlparse.urlsplit(uri)
+    if parts.scheme == 'https':
+        kwargs = {}
+        if disable_ssl_certificate_validation and hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+        conn = httplib.HTTPSConnection(parts.netloc, timeout=timeout, **kwargs)
+    else:
+        conn = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return conn, path
+
+def open_response(uri, method='GET', body=None, headers=None, timeout=20,
+        disable_ssl_certificate_validation=True, follow_redirects=True, max_redirects=5):
+    """
+    Makes a request, following redirects unless `follow_redirects` is False,
+    and returns a tuple of (connection, response, header dictionary, final
+    URI) without reading the body. The header dictionary is lowercased like
+    httplib2's, with the status as a string under 'status'. The caller must
+    close the connection.
+    """
+    headers = dict(headers or {})
+    for i in range(max_redirects + 1):
+        conn, path = open_connection(uri, timeout, disable_ssl_certificate_validation)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        resp_headers = dict(response.getheaders())
+        resp_headers['status'] = str(response.status)
+        if (follow_redirects and response.status in REDIRECT_STATUSES
+                and 'location' in resp_headers):
+            conn.close()
+            uri = urlparse.urljoin(uri, resp_headers['location'])
+            if response.status in (301, 302, 303):
+                method, body = 'GET', None
+                headers.pop('Content-Type', None)
+            continue
+        return conn, response, resp_headers, uri
+    raise httplib.HTTPException('Too many redirects: %s' % uri)
+
+def download(uri, fp, method='GET', body=None, headers=None, timeout=20,
+        disable_ssl_certificate_validation=True, follow_redirects=True,
+        max_redirects=5, chunk_size=CHUNK_SIZE):
+    """
+    Requests the given URI and writes the decoded body of the response to
+    the file object `fp`, `chunk_size` bytes at a time. Redirects are
+    followed unless `follow_redirects` is False. Returns a Download. Raises
+    IncompleteDownload if the connection closes before as many bytes as the
+    response's Content-Length have arrived.
+    """
+    headers = dict(headers or {})
+    headers.setdefault('accept-encoding', ACCEPT_ENCODING)
+    conn, response, resp_headers, uri = open_response(uri, method, body, headers,
+        timeout, disable_ssl_certificate_validation, follow_redirects, max_redirects)
+    try:
+        decoder = Decoder(resp_headers.get('content-encoding'))
+        bytes_received = bytes_decoded = 0
+        while True:
+            try:
+                chunk = response.read(chunk_size)
+            except httplib.IncompleteRead, e:
+                raise IncompleteDownload('Got %s bytes from %s before the connection closed' % (bytes_received + len(e.partial), uri))
+            if not chunk:
+                break
+            bytes_received += len(chunk)
+            data = decoder.decode(chunk)
+            bytes_decoded += len(data)
+            fp.write(data)
+        # Content-Length counts the bytes as sent, before they're decoded.
+        expected = resp_headers.get('content-length')
+        if (expected and expected.isdigit() and method != 'HEAD' and
+                response.status not in (204, 304) and bytes_received < int(expected)):
+            raise IncompleteDownload('Got %s of %s bytes from %s' % (bytes_received, expected, uri))
+        data = decoder.flush()
+        bytes_decoded += len(data)
+        fp.write(data)
+        return Download(uri, resp_headers, bytes_received, bytes_decoded)
+    finally:
+        conn.close()
+
+
+class IncompleteDownload(socket.error):
+    """
+    The connection closed before the whole body arrived. It's a socket.error
+    so that retries.call_with_retries() retries it like any other dropped
+    connection.
+    """
+    pass
+
+class RangeError(httplib.HTTPException):
+    "The server didn't honor a Range request that it needed to."
+    pass
+
+
+def parse_content_range(value):
+    """
+    Returns a tuple of (first byte, last byte, total length) from a
+    Content-Range header, or None. The total length is None if the server
+    didn't say.
+    """
+    match = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', value or '')
+    if match is None:
+        return None
+    first, last, total = match.groups()
+    return int(first), int(last), None if total == '*' else int(total)
+
+
+class PartialFile(object):
+    """
+    A response body kept on disk exactly as it arrives (still compressed, if
+    the server compressed it), so that if the connection drops it can be
+    picked up where it left off with a Range request, even by a later run.
+    What's needed to resume -- the validator the server sent and the
+    expected length -- is kept in <filename>.json. A partial file is only
+    resumed with If-Range, so that if the file has changed on the server in
+    the meantime, it's downloaded from the start instead.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.meta_filename = filename + '.json'
+        self.meta = {}
+        if os.path.exists(filename):
+            try:
+                with open(self.meta_filename) as fp:
+                    self.meta = json.load(fp)
+            except (IOError, ValueError):
+                pass
+
+    @property
+    def size(self):
+        if os.path.exists(self.filename):
+            return os.path.getsize(self.filename)
+        return 0
+
+    def get_strong_etag(self):
+        "Returns the ETag the partial file was downloaded with, unless it's weak."
+        etag = self.meta.get('etag')
+        if etag and not etag.startswith('W/'):
+            return str(etag)
+        return None
+
+    def get_validator(self):
+        "Returns the ETag or Last-Modified the partial file was downloaded with."
+        if self.get_strong_etag() is not None:
+            return self.get_strong_etag()
+        if self.meta.get('last_modified'):
+            return str(self.meta['last_modified'])
+        return None
+
+    def is_current(self, uri, headers=None, timeout=20, disable_ssl_certificate_validation=True,
+            follow_redirects=True):
+        """
+        Returns True if the server says the file the partial file holds
+        hasn't changed, by asking for its first byte with If-Range.
+        """
+        headers = dict((k, v) for k, v in (headers or {}).items()
+            if k.lower() not in ('if-none-match', 'if-modified-since'))
+        headers['range'] = 'bytes=0-0'
+        headers['if-range'] = self.get_validator()
+        headers['accept-encoding'] = 'identity'
+        conn, response, resp_headers, uri = open_response(uri, 'GET', None, headers,
+            timeout, disable_ssl_certificate_validation, follow_redirects)
+        conn.close()
+        return response.status == 206
+
+    def fetch(self, uri, start=0, end=None, validator=None, headers=None, timeout=20,
+            disable_ssl_certificate_validation=True, follow_redirects=True, chunk_size=CHUNK_SIZE):
+        """
+        Downloads bytes `start` through `end` (or the end of the file, if
+        `end` is None) of the given URI into the partial file, resuming after
+        whatever it already holds if possible. If `validator` is given, the
+        bytes must come from the version of the file with that ETag or
+        Last-Modified. Returns a tuple of (header dictionary, bytes received).
+        A response that isn't 200 or 206 is returned without being saved.
+        Raises IncompleteDownload if the connection drops, leaving what
+        arrived in the partial file.
+        Ranges are asked for without compression, since the bytes of two
+        separately compressed responses only line up if the server has a
+        strong ETag. A compressed partial file is only resumed if it has one.
+        """
+        whole = start == 0 and end is None
+        if self.size and (self.get_validator() is None or
+                (validator is not None and validator != self.get_validator())):
+            self.delete()
+        encoded = self.size and self.meta.get('headers', {}).get('content-encoding')
+        if encoded and self.get_strong_etag() is None:
+            self.delete()
+            encoded = None
+        if self.size and self.meta.get('length') is not None and self.size >= self.meta['length']:
+            # Already complete, perhaps from an earlier run. Unless the caller
+            # has just checked the validator, make sure the file hasn't
+            # changed on the server since.
+            if validator is not None or self.is_current(uri, headers, timeout,
+                    disable_ssl_certificate_validation, follow_redirects):
+                return dict(self.meta['headers'], status='200'), 0
+            self.delete()
+            encoded = None
+        offset = start + self.size
+        headers = dict(headers or {})
+        if (offset > 0 or end is not None) and not encoded:
+            headers['accept-encoding'] = 'identity'
+        headers.setdefault('accept-encoding', ACCEPT_ENCODING)
+        if offset > 0 or end is not None:
+            headers['range'] = 'bytes=%s-%s' % (offset, '' if end is None else end)
+            if_range = validator or self.get_validator()
+            if if_range:
+                headers['if-range'] = if_range
+        conn, response, resp_headers, uri = open_response(uri, 'GET', None, headers,
+            timeout, disable_ssl_certificate_validation, follow_redirects)
+        try:
+            if response.status == 206:
+                content_range = parse_content_range(resp_headers.get('content-range'))
+                if content_range is None or content_range[0] != offset:
+                    raise RangeError('Asked %s for bytes from %s, got %r' % (uri, offset, resp_headers.get('content-range')))
+                if not self.size:
+                    if end is None:
+                        length = content_range[2]
+                    else:
+                        length = end - start + 1
+                    self.start(resp_headers, length)
+                mode = 'ab'
+            elif response.status == 200:
+                if not whole:
+                    raise RangeError('%s ignored a Range request' % uri)
+                length = resp_headers.get('content-length')
+                self.start(resp_headers, int(length) if length else None)
+                mode = 'wb'
+            elif response.status == 416 and offset > start:
+                # The partial file can't be what it claims to be.
+                self.delete()
+                raise IncompleteDownload('%s rejected a request for bytes from %s; starting over' % (uri, offset))
+            else:
+                return resp_headers, 0
+
+            expected = resp_headers.get('content-length')
+            bytes_received = 0
+            with open(self.filename, mode) as fp:
+                while True:
+                    try:
+                        chunk = response.read(chunk_size)
+                    except httplib.IncompleteRead, e:
+                        fp.write(e.partial)
+                        bytes_received += len(e.partial)
+                        chunk = ''
+                    if not chunk:
+                        break
+                    bytes_received += len(chunk)
+                    fp.write(chunk)
+            if expected is not None and bytes_received < int(expected):
+                raise IncompleteDownload('Got %s of %s bytes from %s' % (bytes_received, expected, uri))
+            if self.meta.get('length') is not None and self.size < self.meta['length']:
+                raise IncompleteDownload('Got %s of %s bytes from %s' % (self.size, self.meta['length'], uri))
+            return dict(self.meta['headers'], status='200'), bytes_received
+        finally:
+            conn.close()
+
+    def start(self, resp_headers, length):
+        "Starts the partial file over for a response with the given headers."
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.meta = {
+            'etag': resp_headers.get('etag'),
+            'last_modified': resp_headers.get('last-modified'),
+            'length': length,
+            'headers': dict((k, v) for k, v in resp_headers.items()
+                if k not in ('status', 'content-range', 'content-length')),
+        }
+        with open(self.meta_filename, 'w') as fp:
+            json.dump(self.meta, fp)
+        open(self.filename, 'wb').close()
+
+    def delete(self):
+        for filename in (self.filename, self.meta_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
+        self.meta = {}
+
+
+def decode_files(filenames, fp, encoding, chunk_size=CHUNK_SIZE):
+    """
+    Decodes the concatenation of the given files, compressed with the given
+    Content-Encoding, into the file object `fp`. Returns the number of bytes
+    written.
+    """
+    decoder = Decoder(encoding)
+    bytes_decoded = 0
+    for filename in filenames:
+        with open(filename, 'rb') as part:
+            while True:
+                chunk = part.read(chunk_size)
+                if not chunk:
+                    break
+                data = decoder.decode(chunk)
+                bytes_decoded += len(data)
+                fp.write(data)
+    data = decoder.flush()
+    fp.write(data)
+    return bytes_decoded + len(data)
+
+def resumable_download(uri, fp, part_filename, headers=None, timeout=20,
+        disable_ssl_certificate_validation=True, follow_redirects=True,
+        num_parts=1, min_part_size=8 * 1024 * 1024, chunk_size=CHUNK_SIZE):
+    """
+    Like download() for a GET request, but the raw body is kept in
+    `part_filename` until all of it has arrived, and is only then decoded
+    into `fp`. If the connection drops, IncompleteDownload is raised and
+    calling this again resumes the download with a Range request, if the
+    server supports them. If `num_parts` is more than 1 and the server
+    supports ranges, the file is fetched as up to that many byte ranges at
+    once, each at least `min_part_size` bytes and each resumable on its own.
+    """
+    options = dict(headers=headers, timeout=timeout, follow_redirects=follow_redirects,
+        disable_ssl_certificate_validation=disable_ssl_certificate_validation,
+        chunk_size=chunk_size)
+    if num_parts > 1:
+        result = parallel_download(uri, fp, part_filename, num_parts, min_part_size, **options)
+        if result is not None:
+            return result
+    part = PartialFile(part_filename)
+    resp_headers, bytes_received = part.fetch(uri, **options)
+    if resp_headers['status'] != '200':
+        return Download(uri, resp_headers, bytes_received, 0)
+    bytes_decoded = decode_files([part.filename], fp, resp_headers.get('content-encoding'), chunk_size)
+    part.delete()
+    return Download(uri, resp_headers, bytes_received, bytes_decoded)
+
+def parallel_download(uri, fp, part_filename, num_parts, min_part_size, headers=None,
+        timeout=20, disable_ssl_certificate_validation=True, follow_redirects=True,
+        chunk_size=CHUNK_SIZE):
+    """
+    Fetches the given URI as several byte ranges at once, into
+    <part_filename>.0, <part_filename>.1 and so on, and decodes them into
+    `fp` in order. Returns a Download, or None if the server doesn't support
+    ranges, didn't send a validator or the file is too small to split.
+    Raises IncompleteDownload, keeping the parts for the next call, if any
+    part got an error response or didn't all arrive.
+    """
+    # Ask for the first byte to find out the length and validator.
+    # Parts are fetched without compression, so the probe is too.
+    probe_headers = dict(headers or {}, range='bytes=0-0')
+    probe_headers['accept-encoding'] = 'identity'
+    conn, response, resp_headers, uri = open_response(uri, 'GET', None, probe_headers,
+        timeout, disable_ssl_certificate_validation, follow_redirects)
+    conn.close()
+    if response.status == 304:
+        return Download(uri, resp_headers, 0, 0)
+    content_range = parse_content_range(resp_headers.get('content-range'))
+    etag = resp_headers.get('etag')
+    validator = etag if etag and not etag.startswith('W/') else resp_headers.get('last-modified')
+    if response.status != 206 or content_range is None or content_range[2] is None or not validator:
+        return None
+    length = content_range[2]
+    num_parts = min(num_parts, length // min_part_size)
+    if num_parts < 2:
+        return None
+
+    part_size = -(-length // num_parts)
+    ranges = [(i, i * part_size, min(length, (i + 1) * part_size) - 1) for i in range(num_parts)]
+    parts = [PartialFile('%s.%s' % (part_filename, i)) for i in range(num_parts)]
+    def fetch(request):
+        # Let every part finish before giving up on any of them, so that none
+        # is still being written to when this is called again to resume.
+        i, start, end = request
+        try:
+            return parts[i].fetch(uri, start, end, validator, headers, timeout,
+                disable_ssl_certificate_validation, False, chunk_size), None
+        except Exception:
+            return None, sys.exc_info()
+    bytes_received = 0
+    results = list(fetcher.fetch_all(fetch, ranges, num_parts, num_parts, host=lambda request: uri))
+    for (i, start, end), (result, exc_info) in results:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        part_headers, received = result
+        bytes_received += received
+        # A part that got an error response is left as it was, possibly
+        # empty or cut short by an earlier run, so it mustn't be decoded.
+        if part_headers['status'] != '200':
+            raise IncompleteDownload('Got HTTP status %s for bytes %s-%s of %s' % (part_headers['status'], start, end, uri))
+        if parts[i].size != parts[i].meta.get('length'):
+            raise IncompleteDownload('Got %s of %s bytes for bytes %s-%s of %s' % (parts[i].size, parts[i].meta.get('length'), start, end, uri))
+    final_headers = dict(parts[0].meta['headers'], status='200')
+    bytes_decoded = decode_files([part.filename for part in parts], fp,
+        final_headers.get('content-encoding'), chunk_size)
+    for part in parts:
+        part.delete()
+    return Download(uri, final_headers, bytes_received, bytes_decoded)